@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""data
+
+Synthetic, deterministic libraries and lists for the benchmarks
+"""
+
+import os
+import random
+
+GENRES = ('Action', 'Adventure', 'Animation', 'Comedy', 'Crime', 'Drama',
+          'Family', 'Fantasy', 'Horror', 'Mystery', 'Romance',
+          'Science Fiction', 'Thriller', 'TV Movie')
+
+# Items of the lists that aren't in the source library
+MISSING_RATIO = 0.1
+
+
+class Item(object):
+    """A movie or show, as known to Plex, Trakt and TMDb"""
+
+    def __init__(self, library_type, i):
+        self.library_type = library_type
+        self.i = i
+        self.rating_key = str(10000 + i)
+        self.year = 1950 + i % 76
+        if library_type == 'movie':
+            self.title = u'Movie {}'.format(i)
+        else:
+            self.title = u'Show {}'.format(i)
+        self.imdb = 'tt{:07d}'.format(1000000 + i)
+        self.tmdb = 100000 + i
+        self.tvdb = 300000 + i
+        # Most items use the new Plex agents, the rest a legacy agent
+        self.legacy = i % 4 == 0
+
+    @property
+    def folder_name(self):
+        return u'{} ({})'.format(self.title, self.year)
+
+    def guids(self):
+        """Return the item's guid and Guid tags"""
+        if self.legacy and self.library_type == 'movie':
+            return ('com.plexapp.agents.imdb://{}?lang=en'.format(self.imdb),
+                    [])
+        if self.legacy:
+            return ('com.plexapp.agents.thetvdb://{}?lang=en'.format(
+                self.tvdb), [])
+        kind = 'movie' if self.library_type == 'movie' else 'show'
+        guids = ['imdb://' + self.imdb, 'tmdb://{}'.format(self.tmdb)]
+        if self.library_type == 'tv':
+            guids.append('tvdb://{}'.format(self.tvdb))
+        return 'plex://{}/{:024x}'.format(kind, self.i), guids
+
+    def trakt(self):
+        ids = {
+            'trakt': self.i,
+            'slug': self.folder_name.lower().replace(' ', '-'),
+            'imdb': self.imdb,
+            'tmdb': self.tmdb,
+        }
+        if self.library_type == 'movie':
+            return {'movie': {
+                'title': self.title,
+                'year': self.year,
+                'ids': ids,
+                'released': '{}-06-15'.format(self.year),
+            }}
+        ids['tvdb'] = self.tvdb
+        return {'show': {
+            'title': self.title,
+            'year': self.year,
+            'ids': ids,
+        }}
+
+    def tmdb_details(self):
+        details = {
+            'id': self.tmdb,
+            'popularity': (self.i * 7919 % 1000) / 10.0 + 0.1,
+            'vote_average': (self.i % 90) / 10.0 + 1,
+            'vote_count': self.i * 31 % 5000,
+            'genres': [{'id': g, 'name': GENRES[(self.i + g) % len(GENRES)]}
+                       for g in range(1 + self.i % 3)],
+        }
+        if self.library_type == 'movie':
+            details['imdb_id'] = self.imdb
+            details['release_date'] = '{}-06-15'.format(self.year)
+            details['release_dates'] = {'results': []}
+        else:
+            details['first_air_date'] = '{}-01-10'.format(self.year)
+            details['last_air_date'] = '{}-03-20'.format(
+                min(self.year + self.i % 10, 2025))
+        return details
+
+
+class Universe(object):
+    """The source library plus the list items missing from it"""
+
+    def __init__(self, library_type, size, seed=0):
+        self.library_type = library_type
+        self.size = size
+        total = int(size * (1 + MISSING_RATIO))
+        self.items = [Item(library_type, i) for i in range(total)]
+        self.library = self.items[:size]
+        self.by_tmdb = dict((item.tmdb, item) for item in self.items)
+        self.seed = seed
+
+    def ranking(self, name, version=0):
+        """Return all items in the order of a list
+
+        Each version of a list moves a few percent of its items.
+        """
+        rng = random.Random('{}:{}'.format(self.seed, name))
+        items = list(self.items)
+        rng.shuffle(items)
+        rng = random.Random('{}:{}:{}'.format(self.seed, name, version))
+        for _ in range(version * max(len(items) // 50, 1)):
+            a, b = rng.randrange(len(items)), rng.randrange(len(items))
+            items[a], items[b] = items[b], items[a]
+        return items
+
+    def media_path(self, root, item):
+        """Return the file (movies) or show folder of an item"""
+        if self.library_type == 'movie':
+            return os.path.join(root, item.folder_name,
+                                item.folder_name + '.mkv')
+        return os.path.join(root, item.folder_name)
+
+    def create_files(self, root):
+        """Create the folders and (empty) files of the source library"""
+        marker = os.path.join(root, '.complete')
+        if os.path.exists(marker):
+            return
+        for item in self.library:
+            path = self.media_path(root, item)
+            if self.library_type == 'movie':
+                folder = os.path.dirname(path)
+                if not os.path.isdir(folder):
+                    os.makedirs(folder)
+                open(path, 'a').close()
+            else:
+                season = os.path.join(path, 'Season 1')
+                if not os.path.isdir(season):
+                    os.makedirs(season)
+                open(os.path.join(season, 'S01E01.mkv'), 'a').close()
+        open(marker, 'a').close()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""Offline benchmarks of plexlibrary recipes
+
+Runs a recipe against local stand-ins for Plex, Trakt and TMDb with
+synthetic libraries and lists, times every phase of the run and compares
+the timings with stored baselines.
+
+    python benchmarks/run.py --sizes 1000,10000 --latency 0.02
+    python benchmarks/run.py --save-baseline
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import yaml
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, os.path.pardir,
+                                'plexlibrary'))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import plexutils  # noqa: E402
+from clients import Clients  # noqa: E402
+from data import Universe  # noqa: E402
+from recipe import Recipe  # noqa: E402
+from requests.adapters import HTTPAdapter  # noqa: E402
+from standins import PlexStandIn, TMDbStandIn, TraktStandIn  # noqa: E402
+
+SCENARIOS = ('cold', 'unchanged', 'changed', 'sort_only')
+RECIPE_NAME = 'benchmark'
+TRAKT_URL = 'https://api.trakt.tv'
+
+
+class RedirectAdapter(HTTPAdapter):
+    """Send the requests for one site to another base url"""
+
+    def __init__(self, prefix, target):
+        super(RedirectAdapter, self).__init__()
+        self.prefix = prefix
+        self.target = target
+
+    def send(self, request, **kwargs):
+        if request.url.startswith(self.prefix):
+            request.url = self.target + request.url[len(self.prefix):]
+        return super(RedirectAdapter, self).send(request, **kwargs)
+
+
+class Bench(object):
+    """Stand-ins, files and configuration for one library type and size"""
+
+    def __init__(self, library_type, size, workdir, latency, scan_time):
+        self.library_type = library_type
+        self.size = size
+        self.universe = Universe(library_type, size)
+        self.source_root = os.path.join(
+            workdir, 'media', '{}-{}'.format(library_type, size))
+        self.root = os.path.join(workdir, '{}-{}'.format(library_type,
+                                                         size))
+        self.universe.create_files(self.source_root)
+        self.plex = PlexStandIn(self.universe, self.source_root, latency,
+                                scan_time).start()
+        self.trakt = TraktStandIn(self.universe, latency).start()
+        self.tmdb = TMDbStandIn(self.universe, latency).start()
+        self.config_file = os.path.join(self.root, 'config.yml')
+
+    def stop(self):
+        for standin in (self.plex, self.trakt, self.tmdb):
+            standin.stop()
+
+    def reset(self):
+        """Start over with an empty new library and no caches"""
+        self.plex.reset()
+        self.trakt.version = 0
+        if os.path.isdir(self.root):
+            shutil.rmtree(self.root)
+        os.makedirs(self.root)
+        self._write_config()
+
+    def _write_config(self):
+        config = {
+            'plex': {
+                'baseurl': self.plex.url,
+                'token': 'benchmark',
+                'snapshot_dir': os.path.join(self.root, 'snapshots'),
+                'scan_timeout': 600,
+            },
+            'crosswalk_file': os.path.join(self.root, 'ids.sqlite'),
+            'trakt': {
+                'username': 'benchmark',
+                'client_id': 'benchmark',
+                'client_secret': 'benchmark',
+                'oauth_token': 'benchmark',
+                'cache_file': os.path.join(self.root, 'trakt.sqlite'),
+            },
+            'tmdb': {
+                'api_key': 'benchmark',
+                'cache_file': os.path.join(self.root, 'tmdb.sqlite'),
+                'base_url': self.tmdb.url + '/3',
+                'rate_limit': 10000,
+            },
+            'tvdb': {
+                'username': '',
+                'api_key': '',
+                'user_key': '',
+            },
+        }
+        with open(self.config_file, 'w') as f:
+            yaml.safe_dump(config, f, default_flow_style=False)
+
+        list_type = 'movies' if self.library_type == 'movie' else 'shows'
+        recipe = {
+            'library_type': self.library_type,
+            'trakt_oauth': True,
+            'source_list_urls': [
+                '{}/{}/popular?limit={}'.format(
+                    TRAKT_URL, list_type, len(self.universe.items)),
+            ],
+            'source_libraries': [
+                {'name': 'Source', 'folders': [self.source_root]},
+            ],
+            'new_library': {
+                'name': 'Benchmark',
+                'folder': os.path.join(self.root, 'library'),
+                'sort': True,
+                'sort_title': {
+                    'format': '{number}. {title}',
+                    'visible': False,
+                    'absolute': True,
+                },
+                'max_age': 0,
+                'max_count': 0,
+                'remove_from_library': True,
+                'fs_workers': 4,
+            },
+            'weighted_sorting': {
+                'enabled': True,
+                'better_release_date': False,
+                'weights': {
+                    'index': 0.75,
+                    'vote': 0.1,
+                    'age': 0.1,
+                    'random': 0.0,
+                    'genre_bias': {'TV Movie': 0.7},
+                },
+            },
+        }
+        with open(os.path.join(self.root, RECIPE_NAME + '.yml'), 'w') as f:
+            yaml.safe_dump(recipe, f, default_flow_style=False)
+
+    def run(self, scenario, verbose=False):
+        """Run the recipe once
+
+        Returns the phase timings from the metrics of the run and the
+        number of requests each stand-in answered. Every run gets new
+        clients, like a new process would; only the caches on disk are
+        kept between the scenarios.
+        """
+        if scenario == 'changed':
+            self.trakt.version += 1
+        counts = [s.requests for s in (self.plex, self.trakt, self.tmdb)]
+        clients = Clients(self.config_file)
+        trakt = clients.trakt(True)
+        trakt.http.session.mount(TRAKT_URL, RedirectAdapter(
+            TRAKT_URL, self.trakt.url))
+        recipe = Recipe(RECIPE_NAME, clients=clients,
+                        recipe_directory=self.root)
+        if verbose:
+            recipe.run(scenario == 'sort_only')
+        else:
+            with contextlib.redirect_stdout(io.StringIO()):
+                recipe.run(scenario == 'sort_only')
+        if clients.crosswalk is not None:
+            clients.crosswalk.close()
+        summary = recipe.run_metrics.summary()
+        res = dict(summary.get('phase_seconds', {}))
+        res['total'] = summary['run_duration_seconds']
+        for name, standin, count in zip(
+                ('plex', 'trakt', 'tmdb'),
+                (self.plex, self.trakt, self.tmdb), counts):
+            res[name + '_requests'] = standin.requests - count
+        return res
+
+
+def compare(results, baseline, threshold, min_delta):
+    """Return the (case, phase, baseline, result) of the regressions"""
+    regressions = []
+    for case, phases in sorted(results.items()):
+        for phase, seconds in sorted(phases.items()):
+            if phase.endswith('_requests'):
+                continue
+            old = baseline.get(case, {}).get(phase)
+            if old is None:
+                continue
+            if seconds > old * threshold and seconds - old > min_delta:
+                regressions.append((case, phase, old, seconds))
+    return regressions
+
+
+def print_table(results, baseline):
+    for case, res in results.items():
+        print(u"{case}".format(case=case))
+        phases = sorted(phase for phase in res
+                        if not phase.endswith('_requests')
+                        and phase != 'total') + ['total']
+        for phase in phases:
+            old = baseline.get(case, {}).get(phase)
+            print(u"  {phase:<18} {seconds:>9.3f}s{old}".format(
+                phase=phase, seconds=res[phase],
+                old=u'  (baseline {:.3f}s)'.format(old)
+                if old is not None else u''))
+        print(u"  requests: plex {plex}, trakt {trakt}, tmdb {tmdb}".format(
+            plex=res['plex_requests'], trakt=res['trakt_requests'],
+            tmdb=res['tmdb_requests']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='1000,10000',
+                        help="library sizes, comma separated")
+    parser.add_argument('--types', default='movie,tv',
+                        help="library types, comma separated")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help="scenarios to run, in order, comma separated")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds added to every stand-in response")
+    parser.add_argument('--scan-time', type=float, default=0.1,
+                        help="seconds each Plex library scan takes")
+    parser.add_argument('--poll-interval', type=float, default=0.1,
+                        help="seconds between checks for finished scans")
+    parser.add_argument('--baseline',
+                        default=os.path.join(BENCHMARKS_DIR,
+                                             'baselines.json'),
+                        help="file with the baseline timings")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store the timings as the new baseline")
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help="slowdown factor that counts as a regression")
+    parser.add_argument('--min-delta', type=float, default=0.05,
+                        help="seconds of slowdown always tolerated")
+    parser.add_argument('--workdir',
+                        help="directory for the files (default: temporary)")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="show the output of the recipe")
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(',')
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("Unknown scenario: {}".format(scenario))
+
+    # Measure the work, not the waiting between checks
+    plexutils.ScanWaiter.poll_interval = args.poll_interval
+    plexutils.ScanWaiter.quiet_period = args.poll_interval
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='plexlibrary-bench-')
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    try:
+        for library_type in args.types.split(','):
+            for size in [int(s) for s in args.sizes.split(',')]:
+                bench = Bench(library_type, size, workdir, args.latency,
+                              args.scan_time)
+                try:
+                    bench.reset()
+                    for scenario in scenarios:
+                        case = '{}-{}-{}'.format(library_type, size,
+                                                 scenario)
+                        print(u"Running {case}...".format(case=case))
+                        results[case] = bench.run(scenario, args.verbose)
+                finally:
+                    bench.stop()
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_table(results, baseline)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(u"Saved the baseline to {}".format(args.baseline))
+        return 0
+
+    regressions = compare(results, baseline, args.threshold,
+                          args.min_delta)
+    for case, phase, old, seconds in regressions:
+        print(u"Regression: {case} {phase} took {seconds:.3f}s, baseline "
+              u"{old:.3f}s".format(case=case, phase=phase, seconds=seconds,
+                                   old=old))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
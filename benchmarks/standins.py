@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+"""standins
+
+Local HTTP servers that answer like Plex, Trakt and TMDb for the endpoints
+plexlibrary uses, serving a synthetic Universe with injectable latency
+"""
+
+import base64
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+from xml.etree import ElementTree
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def _read_frame(rfile):
+    """Return the opcode and payload of a websocket frame from a client
+
+    Returns (None, None) when the connection is closed.
+    """
+    head = rfile.read(2)
+    if len(head) < 2:
+        return None, None
+    length = head[1] & 0x7f
+    if length == 126:
+        length = int.from_bytes(rfile.read(2), 'big')
+    elif length == 127:
+        length = int.from_bytes(rfile.read(8), 'big')
+    mask = rfile.read(4) if head[1] & 0x80 else b''
+    payload = rfile.read(length)
+    if mask:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return head[0] & 0x0f, payload
+
+
+class StandIn(object):
+    """Threaded HTTP server on a free local port
+
+    Subclasses implement handle(), returning (status, headers, body).
+    Every response is held back by `latency` seconds.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        self._count_lock = threading.Lock()
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like the real services
+            protocol_version = 'HTTP/1.1'
+
+            def _dispatch(self, method):
+                standin._dispatch(self, method)
+
+            def do_GET(self):
+                self._dispatch('GET')
+
+            def do_POST(self):
+                self._dispatch('POST')
+
+            def do_PUT(self):
+                self._dispatch('PUT')
+
+            def do_DELETE(self):
+                self._dispatch('DELETE')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _dispatch(self, handler, method):
+        with self._count_lock:
+            self.requests += 1
+        length = int(handler.headers.get('Content-Length') or 0)
+        if length:
+            handler.rfile.read(length)
+        parts = urlsplit(handler.path)
+        query = dict(parse_qsl(parts.query, keep_blank_values=True))
+        if self.latency:
+            time.sleep(self.latency)
+        status, headers, body = self.handle(handler, method, parts.path,
+                                            query)
+        if status is None:
+            # Handled the connection itself
+            return
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def handle(self, handler, method, path, query):
+        raise NotImplementedError
+
+
+def json_response(data, status=200, headers=None):
+    headers = dict(headers or {})
+    headers['Content-Type'] = 'application/json'
+    return status, headers, json.dumps(data).encode('utf-8')
+
+
+def not_found():
+    return 404, {}, b''
+
+
+class PlexStandIn(StandIn):
+    """Plex Media Server with a source section and recipe-made sections
+
+    Scans of the new library sections look at the symlinks in their
+    folder and add the source items they point to. Scan activities are
+    sent to clients of the notification websocket.
+    """
+
+    def __init__(self, universe, source_root, latency=0.0, scan_time=0.1):
+        super(PlexStandIn, self).__init__(latency)
+        self.universe = universe
+        self.source_root = source_root
+        self.scan_time = scan_time
+        self.section_type = ('movie' if universe.library_type == 'movie'
+                             else 'show')
+        self._lock = threading.RLock()
+        self._listeners = []
+        self._next_rating_key = 10 ** 7
+        self.by_folder = dict(
+            (os.path.dirname(universe.media_path(source_root, item))
+             if universe.library_type == 'movie'
+             else universe.media_path(source_root, item), item)
+            for item in universe.library)
+        self.sections = {}
+        self.reset()
+
+    def reset(self):
+        """Remove all but the source section"""
+        with self._lock:
+            now = int(time.time())
+            source = self._new_section('1', 'Source', self.source_root)
+            for item in self.universe.library:
+                path = self.universe.media_path(self.source_root, item)
+                source['items'][item.rating_key] = self._record(
+                    item, item.rating_key, path, now)
+            self.sections = {'1': source}
+
+    def _new_section(self, key, title, location):
+        return {
+            'key': key,
+            'title': title,
+            'location': location,
+            'uuid': str(uuid.uuid4()),
+            'refreshing': 0,
+            'items': {},
+        }
+
+    def _record(self, item, rating_key, path, now):
+        return {
+            'item': item,
+            'ratingKey': rating_key,
+            'title': item.title,
+            'titleSort': None,
+            'path': path,
+            'addedAt': now,
+            'updatedAt': now,
+        }
+
+    # Notifications
+
+    def notify(self, section, event, activity_id):
+        message = json.dumps({'NotificationContainer': {
+            'type': 'activity',
+            'size': 1,
+            'ActivityNotification': [{
+                'event': event,
+                'uuid': activity_id,
+                'Activity': {
+                    'uuid': activity_id,
+                    'type': 'library.update.section',
+                    'Context': {'librarySectionID': section['key']},
+                },
+            }],
+        }}).encode('utf-8')
+        with self._lock:
+            for listener in self._listeners:
+                listener.put(message)
+
+    def _websocket(self, handler):
+        key = handler.headers.get('Sec-WebSocket-Key', '')
+        accept = base64.b64encode(hashlib.sha1(
+            (key + WEBSOCKET_GUID).encode('ascii')).digest()).decode()
+        handler.send_response(101)
+        handler.send_header('Upgrade', 'websocket')
+        handler.send_header('Connection', 'Upgrade')
+        handler.send_header('Sec-WebSocket-Accept', accept)
+        handler.end_headers()
+        handler.wfile.flush()
+        messages = queue.Queue()
+        write_lock = threading.Lock()
+
+        def write(opcode, payload):
+            if len(payload) < 126:
+                header = bytes([0x80 | opcode, len(payload)])
+            else:
+                header = bytes([0x80 | opcode, 126]) + len(
+                    payload).to_bytes(2, 'big')
+            with write_lock:
+                handler.wfile.write(header + payload)
+                handler.wfile.flush()
+
+        def read():
+            # Answer pings and the close frame, the client waits for it
+            try:
+                while True:
+                    opcode, payload = _read_frame(handler.rfile)
+                    if opcode is None:
+                        break
+                    if opcode == 0x8:
+                        write(0x8, payload[:2])
+                        break
+                    if opcode == 0x9:
+                        write(0xA, payload)
+            except (OSError, ValueError):
+                pass
+            finally:
+                messages.put(None)
+
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        with self._lock:
+            self._listeners.append(messages)
+        reader.start()
+        try:
+            while True:
+                message = messages.get()
+                if message is None:
+                    break
+                write(0x1, message)
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._lock:
+                self._listeners.remove(messages)
+            handler.close_connection = True
+
+    # Scans
+
+    def _scan(self, section, path=None):
+        """Sync the items of a new library section with its folder"""
+        folder = section['location']
+        only = None
+        if path:
+            rel_path = os.path.relpath(path, folder)
+            only = rel_path.split(os.sep)[0]
+        now = int(time.time())
+        found = {}
+        names = [only] if only else os.listdir(folder)
+        for name in names:
+            link = os.path.join(folder, name)
+            if not os.path.islink(link):
+                continue
+            target = os.path.normpath(os.readlink(link))
+            item = self.by_folder.get(target)
+            if item is not None:
+                found[link] = item
+        with self._lock:
+            by_path = dict((r['path'], r) for r in section['items'].values())
+            for link, item in found.items():
+                if self.universe.library_type == 'movie':
+                    path = os.path.join(link, item.folder_name + '.mkv')
+                else:
+                    path = link
+                if path in by_path:
+                    continue
+                self._next_rating_key += 1
+                rating_key = str(self._next_rating_key)
+                section['items'][rating_key] = self._record(
+                    item, rating_key, path, now)
+            for record in list(section['items'].values()):
+                link = record['path']
+                if self.universe.library_type == 'movie':
+                    link = os.path.dirname(link)
+                if only and os.path.basename(link) != only:
+                    continue
+                if link not in found:
+                    del section['items'][record['ratingKey']]
+
+    def start_scan(self, section, path=None):
+        activity_id = str(uuid.uuid4())
+        with self._lock:
+            section['refreshing'] += 1
+
+        def scan():
+            self.notify(section, 'started', activity_id)
+            time.sleep(self.scan_time)
+            try:
+                self._scan(section, path)
+            finally:
+                with self._lock:
+                    section['refreshing'] -= 1
+                self.notify(section, 'ended', activity_id)
+
+        thread = threading.Thread(target=scan)
+        thread.daemon = True
+        thread.start()
+
+    # XML
+
+    def _xml(self, root):
+        return 200, {'Content-Type': 'text/xml'}, ElementTree.tostring(root)
+
+    def _section_element(self, section):
+        element = ElementTree.Element('Directory', {
+            'key': section['key'],
+            'type': self.section_type,
+            'title': section['title'],
+            'uuid': section['uuid'],
+            'refreshing': '1' if section['refreshing'] else '0',
+            'agent': 'tv.plex.agents.movie',
+            'scanner': 'Plex Movie',
+            'language': 'en-US',
+        })
+        ElementTree.SubElement(element, 'Location', {
+            'id': section['key'], 'path': section['location']})
+        return element
+
+    def _item_element(self, record):
+        item = record['item']
+        guid, guids = item.guids()
+        attrib = {
+            'ratingKey': record['ratingKey'],
+            'key': '/library/metadata/' + record['ratingKey'],
+            'guid': guid,
+            'title': record['title'],
+            'year': str(item.year),
+            'originallyAvailableAt': '{}-06-15'.format(item.year),
+            'addedAt': str(record['addedAt']),
+            'updatedAt': str(record['updatedAt']),
+        }
+        if record['titleSort']:
+            attrib['titleSort'] = record['titleSort']
+        if self.universe.library_type == 'movie':
+            attrib['type'] = 'movie'
+            element = ElementTree.Element('Video', attrib)
+            media = ElementTree.SubElement(element, 'Media')
+            ElementTree.SubElement(media, 'Part', {'file': record['path']})
+        else:
+            attrib['type'] = 'show'
+            element = ElementTree.Element('Directory', attrib)
+            ElementTree.SubElement(element, 'Location',
+                                   {'path': record['path']})
+        for g in guids:
+            ElementTree.SubElement(element, 'Guid', {'id': g})
+        return element
+
+    def _container(self, handler, elements):
+        total = len(elements)
+        start = int(handler.headers.get('X-Plex-Container-Start') or 0)
+        size = handler.headers.get('X-Plex-Container-Size')
+        if size is not None:
+            elements = elements[start:start + int(size)]
+        root = ElementTree.Element('MediaContainer', {
+            'size': str(len(elements)), 'totalSize': str(total)})
+        root.extend(elements)
+        return self._xml(root)
+
+    # Endpoints
+
+    def handle(self, handler, method, path, query):
+        parts = [p for p in path.split('/') if p]
+        if path == '/:/websockets/notifications':
+            self._websocket(handler)
+            return None, None, None
+        if not parts:
+            return self._xml(ElementTree.Element('MediaContainer', {
+                'friendlyName': 'plexlibrary benchmark',
+                'machineIdentifier': 'benchmark',
+                'version': '1.40.0.0',
+                'size': '0'}))
+        if parts == ['library']:
+            return self._xml(ElementTree.Element('MediaContainer', {
+                'identifier': 'com.plexapp.plugins.library',
+                'title1': 'Plex Library', 'size': '0'}))
+        if parts == ['library', 'sections']:
+            if method == 'POST':
+                return self._create_section(query)
+            with self._lock:
+                elements = [self._section_element(s)
+                            for s in self.sections.values()]
+            return self._container(handler, elements)
+        if len(parts) >= 4 and parts[:2] == ['library', 'sections']:
+            section = self.sections.get(parts[2])
+            if section is None:
+                return not_found()
+            if parts[3] == 'all' and method == 'PUT':
+                return self._edit(section, query)
+            if parts[3] == 'all':
+                return self._list(handler, section, query)
+            if parts[3] == 'refresh':
+                self.start_scan(section, query.get('path'))
+                return 200, {}, b''
+            if parts[3] == 'emptyTrash':
+                return 200, {}, b''
+        if len(parts) == 4 and parts[:2] == ['library', 'metadata'] \
+                and parts[3] == 'allLeaves':
+            return self._episodes(handler, parts[2])
+        return not_found()
+
+    def _create_section(self, query):
+        with self._lock:
+            key = str(max(int(k) for k in self.sections) + 1)
+            section = self._new_section(key, query['name'],
+                                        query['location'])
+            self.sections[key] = section
+        self.start_scan(section)
+        return 201, {}, b''
+
+    def _list(self, handler, section, query):
+        filters = []
+        for name, value in query.items():
+            if name.endswith('>>'):
+                filters.append((name[:-2], int(value)))
+        with self._lock:
+            records = [r for r in section['items'].values()
+                       if all(r[f] > v for f, v in filters)]
+            records.sort(key=lambda r: int(r['ratingKey']))
+            elements = [self._item_element(r) for r in records]
+        return self._container(handler, elements)
+
+    def _edit(self, section, query):
+        with self._lock:
+            record = section['items'].get(query.get('id'))
+            if record is None:
+                return not_found()
+            if 'title.value' in query:
+                record['title'] = query['title.value']
+            if 'titleSort.value' in query:
+                record['titleSort'] = query['titleSort.value']
+            record['updatedAt'] = int(time.time())
+        return 200, {}, b''
+
+    def _episodes(self, handler, rating_key):
+        with self._lock:
+            record = None
+            for section in self.sections.values():
+                record = section['items'].get(rating_key) or record
+        if record is None:
+            return not_found()
+        element = ElementTree.Element('Video', {
+            'ratingKey': rating_key + '01', 'type': 'episode',
+            'title': 'Episode 1', 'index': '1', 'parentIndex': '1'})
+        media = ElementTree.SubElement(element, 'Media')
+        ElementTree.SubElement(media, 'Part', {'file': os.path.join(
+            record['path'], 'Season 1', 'S01E01.mkv')})
+        return self._container(handler, [element])
+
+
+class TraktStandIn(StandIn):
+    """Trakt lists; any path serves a ranking of the whole universe
+
+    Pages carry ETags and the X-Pagination headers. Bump `version` to
+    move some of the items of every list.
+    """
+
+    def __init__(self, universe, latency=0.0):
+        super(TraktStandIn, self).__init__(latency)
+        self.universe = universe
+        self.version = 0
+        self._rankings = {}
+        self._lock = threading.Lock()
+
+    def ranking(self, path):
+        with self._lock:
+            key = (path, self.version)
+            if key not in self._rankings:
+                self._rankings[key] = [
+                    item.trakt()
+                    for item in self.universe.ranking(path, self.version)]
+            return self._rankings[key]
+
+    def handle(self, handler, method, path, query):
+        items = self.ranking(path)
+        limit = int(query.get('limit') or 10)
+        page = int(query.get('page') or 1)
+        page_items = items[(page - 1) * limit:page * limit]
+        body = json.dumps(page_items).encode('utf-8')
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        headers = {
+            'ETag': etag,
+            'X-Pagination-Page': str(page),
+            'X-Pagination-Limit': str(limit),
+            'X-Pagination-Page-Count': str(-(-len(items) // limit)),
+            'X-Pagination-Item-Count': str(len(items)),
+        }
+        if handler.headers.get('If-None-Match') == etag:
+            return 304, headers, b''
+        headers['Content-Type'] = 'application/json'
+        return 200, headers, body
+
+
+class TMDbStandIn(StandIn):
+    """TMDb movie and TV details and external ids"""
+
+    def __init__(self, universe, latency=0.0):
+        super(TMDbStandIn, self).__init__(latency)
+        self.universe = universe
+
+    def handle(self, handler, method, path, query):
+        parts = [p for p in path.split('/') if p]
+        if len(parts) < 3 or parts[0] != '3':
+            return not_found()
+        try:
+            item = self.universe.by_tmdb[int(parts[2])]
+        except (KeyError, ValueError):
+            return not_found()
+        if parts[1:] == ['tv', parts[2], 'external_ids']:
+            return json_response({'imdb_id': item.imdb,
+                                  'tvdb_id': item.tvdb})
+        if len(parts) == 3:
+            return json_response(item.tmdb_details())
+        return not_found()
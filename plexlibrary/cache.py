@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""cache
+
+Persistent cache for web API responses, backed by SQLite
+"""
+
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DAY = 3600 * 24
+
+
+class Cache(object):
+    """Key/value store kept open for the whole run
+
+    Entries are keyed on (type, id, endpoint), e.g. ('movie', '603',
+    'details'), and expire after the TTL of their endpoint. The database
+    runs in WAL mode so several processes can share it, and a small LRU
+    in front of it serves repeated reads from memory.
+    """
+
+    def __init__(self, path, ttls=None, default_ttl=DAY, lru_size=1024):
+        self.path = path
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.lru_size = lru_size
+        self._lru = collections.OrderedDict()
+        self._lock = threading.Lock()
+        try:
+            self.conn = self._connect()
+        except sqlite3.OperationalError:
+            raise
+        except sqlite3.DatabaseError:
+            # Not a database (e.g. an old shelve file), start over
+            os.rename(path, path + '.corrupt')
+            self.conn = self._connect()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30,
+                               check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'type TEXT NOT NULL, id TEXT NOT NULL, '
+                'endpoint TEXT NOT NULL, value TEXT NOT NULL, '
+                'cached INTEGER NOT NULL, '
+                'PRIMARY KEY (type, id, endpoint))')
+        return conn
+
+    def ttl(self, endpoint):
+        return self.ttls.get(endpoint, self.default_ttl)
+
+    def _key(self, item_type, item_id, endpoint):
+        return (str(item_type), str(item_id), str(endpoint))
+
+    def _remember(self, key, value, cached):
+        self._lru[key] = (value, cached)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def get(self, item_type, item_id, endpoint):
+        key = self._key(item_type, item_id, endpoint)
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Return a {(type, id, endpoint): value} dict of the fresh entries"""
+        now = int(time.time())
+        found = {}
+        with self._lock:
+            missing = []
+            for key in keys:
+                key = self._key(*key)
+                if key in self._lru:
+                    value, cached = self._lru[key]
+                    self._lru.move_to_end(key)
+                    if cached + self.ttl(key[2]) > now:
+                        found[key] = value
+                        continue
+                # Expired entries may have been refreshed by another process
+                missing.append(key)
+
+            for key in missing:
+                row = self.conn.execute(
+                    'SELECT value, cached FROM cache '
+                    'WHERE type = ? AND id = ? AND endpoint = ?',
+                    key).fetchone()
+                if not row:
+                    continue
+                try:
+                    value = json.loads(row[0])
+                except ValueError:
+                    # Corrupt entry, drop just this one
+                    with self.conn:
+                        self.conn.execute(
+                            'DELETE FROM cache WHERE type = ? AND id = ? '
+                            'AND endpoint = ?', key)
+                    continue
+                self._remember(key, value, row[1])
+                if row[1] + self.ttl(key[2]) > now:
+                    found[key] = value
+        return found
+
+    def put(self, item_type, item_id, endpoint, value):
+        self.put_many([((item_type, item_id, endpoint), value)])
+
+    def put_many(self, items):
+        """Store (key, value) pairs in a single transaction"""
+        now = int(time.time())
+        rows = []
+        with self._lock:
+            for key, value in items:
+                key = self._key(*key)
+                self._remember(key, value, now)
+                rows.append(key + (json.dumps(value), now))
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO cache '
+                    '(type, id, endpoint, value, cached) '
+                    'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""clients
+
+Web API clients and library snapshots shared by the recipes of a run
+"""
+
+import threading
+import time
+
+import plexapi
+
+import httpclient
+import metrics
+import plexutils
+import snapshot
+import tmdb
+import traktutils
+import tvdb
+from config import ConfigParser
+from crosswalk import Crosswalk
+
+# Names of the web APIs in messages
+SERVICE_NAMES = {
+    'trakt': u'Trakt',
+    'tmdb': u'TMDb',
+    'tvdb': u'TheTVDB',
+}
+
+
+class Clients(object):
+    """Connections and caches that several recipes can share
+
+    Each client is created on first use, once: connecting to Plex,
+    authenticating with Trakt and opening the caches only happens once
+    per process, however many recipes run. Safe to use from several
+    threads.
+
+    Offline, nothing but the caches and the library snapshots is used:
+    there is no Plex client and the snapshots aren't refreshed.
+    """
+    # Seconds during which a refreshed source library snapshot is reused
+    snapshot_max_age = 60
+
+    def __init__(self, config_file=None, config=None, offline=False):
+        self.config = config or ConfigParser(config_file)
+        self.offline = offline
+        # Requests, cache lookups etc. of all the clients
+        self.metrics = metrics.Metrics()
+        self._lock = threading.RLock()
+        self._plex = None
+        self._trakt = {}
+        self._tmdb = None
+        self._tvdb = None
+        self._crosswalk = None
+        # {service: httpclient.HostClient}
+        self._http = {}
+        # {section uuid: [snapshot, lock, time of the last refresh]}
+        self._snapshots = {}
+
+    @property
+    def plex(self):
+        """The Plex client, or None offline"""
+        if self.offline:
+            return None
+        with self._lock:
+            if self._plex is None:
+                self._plex = plexutils.Plex(self.config['plex']['baseurl'],
+                                            self.config['plex']['token'])
+                self.metrics.instrument(self._plex.session)
+            return self._plex
+
+    def http(self, service, rate=None, period=1.0, max_concurrent=None):
+        """Return the HostClient of a web API, created on first use
+
+        The timeout and max_retries are read from the config section of
+        the service.
+        """
+        with self._lock:
+            if service not in self._http:
+                config = self.config.get(service) or {}
+                timeout = config.get('timeout')
+                if isinstance(timeout, list):
+                    # (connect, read) timeouts
+                    timeout = tuple(timeout)
+                self._http[service] = httpclient.HostClient(
+                    SERVICE_NAMES.get(service, service), rate=rate,
+                    period=period, max_concurrent=max_concurrent,
+                    timeout=timeout, max_retries=config.get('max_retries'))
+                self.metrics.instrument(self._http[service].session)
+            return self._http[service]
+
+    def trakt(self, oauth=False):
+        """Return the Trakt client, or None without a Trakt username"""
+        if not self.config['trakt']['username']:
+            return None
+        with self._lock:
+            if oauth not in self._trakt:
+                self._trakt[oauth] = traktutils.Trakt(
+                    self.config['trakt']['username'],
+                    client_id=self.config['trakt']['client_id'],
+                    client_secret=self.config['trakt']['client_secret'],
+                    oauth_token=self.config['trakt'].get('oauth_token', ''),
+                    oauth=oauth,
+                    cache_file=self.config['trakt'].get('cache_file'),
+                    offline=self.offline,
+                    http=self.http(
+                        'trakt', traktutils.Trakt.rate_limit,
+                        traktutils.Trakt.rate_period,
+                        traktutils.Trakt.max_workers))
+                self._trakt[oauth].crosswalk = self.crosswalk
+                if self._trakt[oauth].oauth_token:
+                    self.config['trakt']['oauth_token'] = \
+                        self._trakt[oauth].oauth_token
+            return self._trakt[oauth]
+
+    @property
+    def crosswalk(self):
+        """The id crosswalk, or None if it has no file configured"""
+        if not self.config.get('crosswalk_file'):
+            return None
+        with self._lock:
+            if self._crosswalk is None:
+                self._crosswalk = Crosswalk(self.config['crosswalk_file'])
+            return self._crosswalk
+
+    @property
+    def tmdb(self):
+        """The TMDb client, or None without a TMDb API key"""
+        if not self.config['tmdb']['api_key']:
+            return None
+        with self._lock:
+            if self._tmdb is None:
+                self._tmdb = tmdb.TMDb(
+                    self.config['tmdb']['api_key'],
+                    cache_file=self.config['tmdb']['cache_file'],
+                    rate_limit=self.config['tmdb'].get('rate_limit'),
+                    max_workers=self.config['tmdb'].get('max_workers'),
+                    cache_ttl=self.config['tmdb'].get('cache_ttl'),
+                    base_url=self.config['tmdb'].get('base_url'),
+                    http=self.http(
+                        'tmdb', self.config['tmdb'].get('rate_limit')
+                        or tmdb.TMDb.rate_limit,
+                        max_concurrent=self.config['tmdb'].get('max_workers')
+                        or tmdb.TMDb.max_workers))
+                self._tmdb.metrics = self.metrics
+                self._tmdb.offline = self.offline
+            return self._tmdb
+
+    @property
+    def tvdb(self):
+        """The TheTVDB client, or None without a TheTVDB username"""
+        if not self.config['tvdb']['username']:
+            return None
+        with self._lock:
+            if self._tvdb is None:
+                self._tvdb = tvdb.TheTVDB(
+                    self.config['tvdb']['username'],
+                    self.config['tvdb']['api_key'],
+                    self.config['tvdb']['user_key'],
+                    cache_file=self.config['tvdb'].get('cache_file'),
+                    rate_limit=self.config['tvdb'].get('rate_limit'),
+                    max_workers=self.config['tvdb'].get('max_workers'),
+                    cache_ttl=self.config['tvdb'].get('cache_ttl'),
+                    base_url=self.config['tvdb'].get('base_url'),
+                    http=self.http(
+                        'tvdb', self.config['tvdb'].get('rate_limit')
+                        or tvdb.TheTVDB.rate_limit,
+                        max_concurrent=self.config['tvdb'].get('max_workers')
+                        or tvdb.TheTVDB.max_workers))
+                self._tvdb.offline = self.offline
+            return self._tvdb
+
+    def section(self, name):
+        """Return the library section with the name, or None"""
+        if self.offline:
+            return snapshot.find_section(
+                name, self.config['plex'].get('snapshot_dir'))
+        try:
+            return self.plex.server.library.section(name)
+        except plexapi.exceptions.NotFound:
+            return None
+
+    def snapshot(self, section, max_age=None):
+        """Return the snapshot of a library section, brought up to date
+
+        The snapshot isn't refreshed again if that was done less than
+        max_age seconds ago (snapshot_max_age by default).
+        """
+        if max_age is None:
+            max_age = self.snapshot_max_age
+        with self._lock:
+            if section.uuid not in self._snapshots:
+                self._snapshots[section.uuid] = [
+                    snapshot.LibrarySnapshot(
+                        self.plex, section,
+                        self.config['plex'].get('snapshot_dir')),
+                    threading.Lock(), None]
+            entry = self._snapshots[section.uuid]
+        library_snapshot, lock = entry[0], entry[1]
+        with lock:
+            # Keep the section up to date, e.g. for a renamed library
+            library_snapshot.section = section
+            if self.offline:
+                return library_snapshot
+            if entry[2] is None or time.monotonic() - entry[2] >= max_age:
+                items = library_snapshot.items
+                library_snapshot.refresh()
+                changed = library_snapshot.items is not items
+                if self.crosswalk is not None and (entry[2] is None
+                                                   or changed):
+                    self.crosswalk.add_guids(
+                        'movie' if section.type == 'movie' else 'tv',
+                        library_snapshot.values())
+                    self.crosswalk.flush()
+                entry[2] = time.monotonic()
+        return library_snapshot
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""crosswalk
+
+Persistent map between the imdb, tmdb, tvdb and Trakt ids (and slugs) of
+movies and shows
+"""
+
+import sqlite3
+import threading
+import time
+
+from plexutils import guid_ids
+
+# In order of preference for the canonical id; slugs change with titles
+SOURCES = ('imdb', 'tmdb', 'tvdb', 'trakt', 'slug')
+
+
+class Crosswalk(object):
+    """Every known id of an item, found from any one of them
+
+    Fed with the ids that come for free with Trakt list items and Plex
+    guids, so resolving e.g. a tmdb id to an imdb id rarely needs a web
+    API. Ids of the same item share a canonical id, the first one seen.
+    The whole table is kept in memory; new ids are written by flush().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # {(type, source, id): canonical id}
+        self._canonical = {}
+        # {(type, canonical id): {source: id}}
+        self._ids = {}
+        self._pending = []
+        self.conn = sqlite3.connect(path, timeout=30,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS ids ('
+                'type TEXT NOT NULL, source TEXT NOT NULL, '
+                'id TEXT NOT NULL, canonical TEXT NOT NULL, '
+                'updated INTEGER NOT NULL, '
+                'PRIMARY KEY (type, source, id))')
+        for row in self.conn.execute(
+                'SELECT type, source, id, canonical FROM ids'):
+            self._set(*row)
+
+    def _set(self, item_type, source, item_id, canonical):
+        old = self._canonical.get((item_type, source, item_id))
+        if old is not None and old != canonical:
+            self._ids.get((item_type, old), {}).pop(source, None)
+        self._canonical[(item_type, source, item_id)] = canonical
+        self._ids.setdefault((item_type, canonical), {})[source] = item_id
+
+    def add(self, item_type, ids):
+        """Record that the ids ({source: id}) belong to the same item"""
+        ids = dict((source, str(ids[source])) for source in SOURCES
+                   if ids.get(source))
+        if len(ids) < 2:
+            # Nothing to connect
+            return
+        with self._lock:
+            canonical = None
+            for source, item_id in ids.items():
+                canonical = self._canonical.get((item_type, source, item_id))
+                if canonical:
+                    break
+            if canonical is None:
+                source = [s for s in SOURCES if s in ids][0]
+                canonical = source + ':' + ids[source]
+            known = self._ids.get((item_type, canonical), {})
+            now = int(time.time())
+            for source, item_id in ids.items():
+                if known.get(source) == item_id and self._canonical.get(
+                        (item_type, source, item_id)) == canonical:
+                    continue
+                self._set(item_type, source, item_id, canonical)
+                self._pending.append(
+                    (item_type, source, item_id, canonical, now))
+
+    def add_guids(self, item_type, records):
+        """Record the ids in the guids of Plex items"""
+        for record in records:
+            self.add(item_type, guid_ids(record['guids']))
+
+    def ids(self, item_type, imdb_id=None, tmdb_id=None, tvdb_id=None,
+            trakt_id=None, slug=None):
+        """Return {source: id} of all the known ids of an item"""
+        given = {'imdb': imdb_id, 'tmdb': tmdb_id, 'tvdb': tvdb_id,
+                 'trakt': trakt_id, 'slug': slug}
+        res = dict((source, str(item_id))
+                   for source, item_id in given.items() if item_id)
+        with self._lock:
+            for source in SOURCES:
+                if not given[source]:
+                    continue
+                canonical = self._canonical.get(
+                    (item_type, source, str(given[source])))
+                if canonical:
+                    for k, v in self._ids.get((item_type, canonical),
+                                              {}).items():
+                        res.setdefault(k, v)
+        return res
+
+    def flush(self):
+        """Write the new ids to the database"""
+        with self._lock:
+            rows, self._pending = self._pending, []
+            if not rows:
+                return
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO ids '
+                    '(type, source, id, canonical, updated) '
+                    'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self.conn.close()
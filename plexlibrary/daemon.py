@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""daemon
+
+Runs recipes on a schedule in one long-running process
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import recipes
+from recipe import run_recipe
+from recipes import RecipeParser
+from utils import write_atomic
+
+# Minutes between runs of recipes without an interval of their own
+DEFAULT_INTERVAL = 24 * 60
+
+
+class Job(object):
+    """The schedule and last run of a recipe"""
+
+    def __init__(self, name):
+        self.name = name
+        self.mtime = None
+        self.interval = DEFAULT_INTERVAL
+        self.next_run = 0
+        self.running = False
+        # Changed while running, run again once done
+        self.rerun = False
+        self.last_start = None
+        self.last_duration = None
+        self.last_ok = None
+        self.runs = 0
+
+    def status(self):
+        return {
+            'interval': self.interval,
+            'next_run': self.next_run,
+            'running': self.running,
+            'last_start': self.last_start,
+            'last_duration': self.last_duration,
+            'last_ok': self.last_ok,
+            'runs': self.runs,
+        }
+
+
+class Daemon(object):
+    """Runs each recipe every `interval` minutes, as set in the recipe
+
+    The clients (Plex connection, web API caches, source library
+    snapshots) stay warm between runs. Recipe files are checked for
+    changes before every round of scheduling, and a recipe never runs
+    twice at the same time. The schedule and timings of the last runs
+    are written to a JSON status file.
+    """
+    # Seconds between checks for recipes that are due
+    poll_interval = 30
+
+    def __init__(self, clients, names=None, workers=1, status_file=None,
+                 default_interval=None):
+        self.clients = clients
+        # None for all recipes, including ones added later
+        self.names = names
+        self.workers = max(workers, 1)
+        self.status_file = status_file or os.path.join(
+            tempfile.gettempdir(), 'plexlibrary_daemon.json')
+        self.default_interval = default_interval or DEFAULT_INTERVAL
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def reload(self):
+        """Pick up new, changed and deleted recipe files"""
+        names = self.names or recipes.get_recipes()
+        with self._lock:
+            for name in list(self.jobs):
+                if name not in names and not self.jobs[name].running:
+                    print(u"Recipe '{}' removed, no longer scheduled".format(
+                        name))
+                    del self.jobs[name]
+            for name in names:
+                try:
+                    mtime = os.path.getmtime(recipes.recipe_path(name))
+                except OSError:
+                    continue
+                job = self.jobs.setdefault(name, Job(name))
+                if job.mtime == mtime:
+                    continue
+                try:
+                    interval = RecipeParser(name).get('interval')
+                except Exception as e:
+                    print(u"Unable to read the recipe '{name}': {e}".format(
+                        name=name, e=e))
+                    continue
+                if job.mtime is not None:
+                    print(u"Recipe '{}' changed, reloaded".format(name))
+                    # Run a changed recipe straight away, or right after
+                    # the current run
+                    if job.running:
+                        job.rerun = True
+                    else:
+                        job.next_run = 0
+                job.mtime = mtime
+                job.interval = interval or self.default_interval
+
+    def due(self):
+        now = time.time()
+        with self._lock:
+            return [job for job in self.jobs.values()
+                    if not job.running and job.next_run <= now]
+
+    def run_job(self, job):
+        start = time.time()
+        job.last_start = start
+        try:
+            job.last_ok = run_recipe(job.name, self.clients)
+        finally:
+            job.last_duration = time.time() - start
+            job.runs += 1
+            with self._lock:
+                if job.rerun:
+                    job.next_run = time.time()
+                    job.rerun = False
+                else:
+                    job.next_run = start + job.interval * 60
+                job.running = False
+        print(u"Recipe '{name}' {result} in {duration:.1f} seconds, next "
+              u"run at {next_run}".format(
+                name=job.name,
+                result=u"finished" if job.last_ok else u"failed",
+                duration=job.last_duration,
+                next_run=time.strftime('%Y-%m-%d %H:%M:%S',
+                                       time.localtime(job.next_run))))
+        self.write_status()
+
+    def write_status(self):
+        with self._lock:
+            status = dict((name, job.status())
+                          for name, job in self.jobs.items())
+        try:
+            write_atomic(self.status_file,
+                         json.dumps(status, indent=2, sort_keys=True))
+        except (IOError, OSError) as e:
+            # Keep scheduling, the status file is only informational
+            print(u"Unable to write the status file {path}: {e}".format(
+                path=self.status_file, e=e))
+
+    def stop(self):
+        self._stop.set()
+
+    def run_forever(self):
+        print(u"Starting the daemon, status in {}".format(self.status_file))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                while not self._stop.is_set():
+                    self.reload()
+                    for job in self.due():
+                        job.running = True
+                        executor.submit(self.run_job, job)
+                    self.write_status()
+                    self._stop.wait(self.poll_interval)
+            except KeyboardInterrupt:
+                print(u"Stopping the daemon after the running recipes...")
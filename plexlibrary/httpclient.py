@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""httpclient
+
+Requests to the web APIs: pooled, rate limited, capped and retried
+"""
+
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ratelimit import RateLimiter, retry_after
+
+# Statuses worth another try, the server may be fine again shortly
+RETRY_STATUSES = (500, 502, 503, 504)
+# Methods that can be sent again without doing anything twice
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+class HostClient(object):
+    """Keep-alive connections to one web API host, shared by all threads
+
+    At most `rate` requests are sent per `period` seconds and at most
+    `max_concurrent` at a time. Requests time out after `timeout` seconds
+    (a number, or a (connect, read) tuple). Rate limited (429) requests
+    are sent again once the Retry-After time has passed; connection
+    errors, timeouts and server errors of idempotent requests are
+    retried with jittered exponential backoff. After max_retries, the
+    last response is returned or the last error raised.
+    """
+    timeout = (10, 30)
+    max_retries = 3
+    # Seconds of the first backoff, doubled for each retry
+    backoff = 1.0
+    max_backoff = 60.0
+
+    def __init__(self, name, rate=None, period=1.0, max_concurrent=None,
+                 timeout=None, max_retries=None):
+        self.name = name
+        if timeout:
+            self.timeout = timeout
+        if max_retries is not None:
+            self.max_retries = max_retries
+        self.limiter = RateLimiter(rate, period) if rate else None
+        self._slots = None
+        if max_concurrent:
+            self._slots = threading.BoundedSemaphore(max_concurrent)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=max_concurrent or 10)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _backoff(self, attempt):
+        # "Full jitter", so clients that failed together retry apart
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    def _send(self, method, url, **kwargs):
+        if self.limiter is not None:
+            self.limiter.wait()
+        if self._slots is None:
+            return self.session.request(method, url, **kwargs)
+        with self._slots:
+            return self.session.request(method, url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        retry = method.upper() in IDEMPOTENT_METHODS
+        for attempt in range(self.max_retries + 1):
+            last = attempt == self.max_retries
+            try:
+                r = self._send(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if last or not retry:
+                    raise
+                delay = self._backoff(attempt)
+                print(u"Request to {name} failed ({e}), retrying in "
+                      u"{delay:.1f} seconds...".format(
+                        name=self.name, e=e, delay=delay))
+            else:
+                if r.status_code == 429 and not last:
+                    delay = retry_after(r)
+                    print(u"Waiting {delay} seconds for the {name} rate "
+                          u"limit...".format(delay=delay, name=self.name))
+                    if self.limiter is not None:
+                        # Hold back the other threads too
+                        self.limiter.block(delay)
+                        continue
+                elif r.status_code in RETRY_STATUSES and retry and not last:
+                    delay = self._backoff(attempt)
+                    if 'Retry-After' in r.headers:
+                        delay = retry_after(r)
+                else:
+                    return r
+            time.sleep(delay)
+        return r
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""mediaitem
+
+Compact model of the movies and shows from the source lists
+"""
+
+
+class MediaItem(object):
+    """A movie or show from a source list, plus its sorting data"""
+    __slots__ = (
+        'id', 'tmdb_id', 'tvdb_id', 'title', 'year',
+        # TMDb details
+        'tmdb_popularity', 'tmdb_vote', 'tmdb_vote_count', 'release_date',
+        'last_air_date', 'genres', 'age',
+        # Weighted sorting
+        'original_idx', 'index_weight', 'vote_weight', 'age_weight',
+        'random_weight', 'weight',
+    )
+
+    def __init__(self, id, tmdb_id='', tvdb_id='', title=None, year=None):
+        self.id = id
+        self.tmdb_id = tmdb_id
+        self.tvdb_id = tvdb_id
+        self.title = title
+        self.year = year
+
+        self.tmdb_popularity = None
+        self.tmdb_vote = None
+        self.tmdb_vote_count = 0
+        self.release_date = None
+        self.last_air_date = None
+        self.genres = ()
+        self.age = 0
+
+        self.original_idx = None
+        self.index_weight = 0.0
+        self.vote_weight = 0.0
+        self.age_weight = 0.0
+        self.random_weight = 0.0
+        self.weight = 0.0
+
+    def __repr__(self):
+        return '<MediaItem {} {} ({})>'.format(self.id, self.title, self.year)
+
+    @property
+    def keys(self):
+        """The item's ids as keys ('tt123', 'tmdb123', 'tvdb123')"""
+        keys = []
+        if self.id:
+            keys.append(str(self.id))
+        if self.tmdb_id:
+            keys.append('tmdb' + str(self.tmdb_id))
+        if self.tvdb_id:
+            keys.append('tvdb' + str(self.tvdb_id))
+        return keys
+
+
+class ItemCollection(object):
+    """Ordered list of MediaItems with O(1) lookup by any of their ids"""
+
+    def __init__(self, items=None):
+        self._items = []
+        self._index = {}
+        for item in items or []:
+            self.add(item)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __getitem__(self, i):
+        return self._items[i]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def add(self, item):
+        """Append an item unless one with any of the same ids exists"""
+        keys = item.keys
+        if any(k in self._index for k in keys):
+            return False
+        self._items.append(item)
+        for k in keys:
+            self._index[k] = item
+        return True
+
+    def get(self, key, default=None):
+        return self._index.get(key, default)
+
+    def sort(self, key=None, reverse=False):
+        self._items.sort(key=key, reverse=reverse)
+
+    def remove_indices(self, indices):
+        """Remove the items at the given positions"""
+        indices = set(indices)
+        self._items = [item for i, item in enumerate(self._items)
+                       if i not in indices]
+        self._index = {}
+        for item in self._items:
+            for k in item.keys:
+                self._index[k] = item
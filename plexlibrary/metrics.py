@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""metrics
+
+Phase timings and counters of recipe runs, written as a JSON summary and
+as a file for the Prometheus node_exporter textfile collector
+"""
+
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+from utils import write_atomic
+
+PREFIX = 'plexlibrary_'
+
+# Upper bounds in seconds of the HTTP request latency buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+DESCRIPTIONS = {
+    'phase_seconds': u"Seconds spent in each phase of the run",
+    'http_requests': u"HTTP requests by host and status",
+    'http_request_duration_seconds': u"HTTP request latency by host",
+    'cache_lookups': u"Cache lookups by service and result",
+    'fs_operations': u"Changes made to the new library folder",
+    'sort_title_writes': u"Sort title edits by result",
+    'run_duration_seconds': u"Seconds the run took",
+    'run_success': u"Whether the run finished without errors",
+    'run_timestamp_seconds': u"When the run finished",
+}
+
+
+class Metrics(object):
+    """Counters, one set of them shared by everything in a process
+
+    Values only grow. The metrics of one run are the difference between
+    a snapshot taken before it and the values after it, see since().
+    When several recipes run at once, each one's HTTP requests and cache
+    lookups include those of the others.
+    """
+
+    def __init__(self, values=None):
+        self._lock = threading.Lock()
+        # {(name, ((label, value), ...)): value}
+        self.values = values or {}
+
+    def add(self, name, value=1, **labels):
+        self.add_many([(name, value, labels)])
+
+    def add_many(self, updates):
+        """Add (name, value, labels) triples at once"""
+        with self._lock:
+            for name, value, labels in updates:
+                key = (name, tuple(sorted(labels.items())))
+                self.values[key] = self.values.get(key, 0) + value
+
+    def observe_request(self, host, seconds, status):
+        """Count an HTTP request and add it to the latency histogram"""
+        name = 'http_request_duration_seconds'
+        updates = [
+            ('http_requests', 1, {'host': host, 'status': str(status)}),
+            (name + '_sum', seconds, {'host': host}),
+            (name + '_count', 1, {'host': host}),
+            (name + '_bucket', 1, {'host': host, 'le': '+Inf'}),
+        ]
+        for bound in LATENCY_BUCKETS:
+            if seconds <= bound:
+                updates.append(
+                    (name + '_bucket', 1, {'host': host, 'le': str(bound)}))
+        self.add_many(updates)
+
+    def instrument(self, session):
+        """Count the requests made through a requests.Session"""
+        def hook(response, *args, **kwargs):
+            self.observe_request(urlsplit(response.url).netloc,
+                                 response.elapsed.total_seconds(),
+                                 response.status_code)
+        session.hooks['response'].append(hook)
+
+    def update(self, other):
+        """Add the values of other Metrics"""
+        with other._lock:
+            values = list(other.values.items())
+        with self._lock:
+            for key, value in values:
+                self.values[key] = self.values.get(key, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.values)
+
+    def since(self, snapshot):
+        """Return the Metrics added since the snapshot was taken
+
+        Metrics that didn't change are kept with a value of 0.
+        """
+        with self._lock:
+            return Metrics(dict(
+                (key, value - snapshot.get(key, 0))
+                for key, value in self.values.items()))
+
+    def summary(self):
+        """Return the values as nested dicts
+
+        Each metric is a number, or a dict keyed on the values of its
+        labels in alphabetical order of the label names.
+        """
+        res = {}
+        for (name, labels), value in sorted(self.values.items()):
+            if not labels:
+                res[name] = value
+                continue
+            node = res.setdefault(name, {})
+            for label, label_value in labels[:-1]:
+                node = node.setdefault(label_value, {})
+            node[labels[-1][1]] = value
+        return res
+
+
+class PhaseTimer(object):
+    """Times consecutive phases, starting one ends the previous one"""
+
+    def __init__(self, metrics=None, **labels):
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.labels = labels
+        self.phase = None
+        self._start = None
+
+    def start(self, phase):
+        self.stop()
+        self.phase = phase
+        self._start = time.monotonic()
+
+    def stop(self):
+        if self.phase is not None:
+            self.metrics.add('phase_seconds',
+                             time.monotonic() - self._start,
+                             phase=self.phase, **self.labels)
+        self.phase = None
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _sample_key(sample):
+    # Histogram buckets in increasing order of their bounds
+    name, labels, value = sample
+    return name, [(k, float(v) if k == 'le' else v) for k, v in labels]
+
+
+def prometheus_text(metrics, **labels):
+    """Return the metrics in the Prometheus text format
+
+    The labels are added to every sample, e.g. the recipe name.
+    """
+    lines = []
+    families = {}
+    values = dict(metrics.values)
+    # Every bucket of the latency histograms, empty ones too
+    bucket = 'http_request_duration_seconds_bucket'
+    for name, sample_labels in list(values):
+        if name == 'http_request_duration_seconds_count':
+            for bound in LATENCY_BUCKETS + ('+Inf',):
+                key = (bucket, tuple(sorted(
+                    dict(sample_labels, le=str(bound)).items())))
+                values.setdefault(key, 0)
+    for (name, sample_labels), value in sorted(values.items()):
+        family = name
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in DESCRIPTIONS:
+                family = name[:-len(suffix)]
+        families.setdefault(family, []).append((name, sample_labels, value))
+    for family, samples in sorted(families.items()):
+        kind = ('histogram' if family == 'http_request_duration_seconds'
+                else 'gauge')
+        if family in DESCRIPTIONS:
+            lines.append(u'# HELP {prefix}{family} {help}'.format(
+                prefix=PREFIX, family=family, help=DESCRIPTIONS[family]))
+        lines.append(u'# TYPE {prefix}{family} {kind}'.format(
+            prefix=PREFIX, family=family, kind=kind))
+        for name, sample_labels, value in sorted(samples, key=_sample_key):
+            all_labels = sorted(dict(sample_labels, **labels).items())
+            label_text = u','.join(u'{}="{}"'.format(k, _escape(str(v)))
+                                   for k, v in all_labels)
+            lines.append(u'{prefix}{name}{labels} {value}'.format(
+                prefix=PREFIX, name=name, value=repr(float(value)),
+                labels=u'{' + label_text + u'}' if label_text else u''))
+    return u'\n'.join(lines) + u'\n'
+
+
+def write_run(directory, recipe_name, metrics, started, finished,
+              success):
+    """Write <recipe>.json and <recipe>.prom for a finished run"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    summary = {
+        'recipe': recipe_name,
+        'started': started,
+        'finished': finished,
+        'success': success,
+        'metrics': metrics.summary(),
+    }
+    write_atomic(os.path.join(directory, recipe_name + '.json'),
+                 json.dumps(summary, indent=2, sort_keys=True))
+    write_atomic(os.path.join(directory, recipe_name + '.prom'),
+                 prometheus_text(metrics, recipe=recipe_name))
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""pipeline
+
+Enrich and match list items while the source lists are still being read
+"""
+
+import queue
+import threading
+
+# Marks the end of the items in a queue
+_DONE = object()
+
+
+class ItemPipeline(object):
+    """Stream list items through TMDb enrichment and matching
+
+    Used as the `enough` callback of Trakt.add_items: every item added to
+    the list is queued for the enrichment workers, which fetch its TMDb
+    details, and then for the matching worker, which looks it up in the
+    source libraries. The queues are bounded, so reading the lists waits
+    when the later stages fall behind.
+
+    With max_count, the items are matched as they are added instead, and
+    reading stops once max_count of them matched (see `done`).
+
+    Only the per-item work is done early. The order of the list, the
+    weighted sorting and max_count are still applied once all the lists
+    are read, from the details and matches collected here. Call close()
+    after reading the lists.
+
+    With a status dict (see Recipe._get_source_lists), details are only
+    fetched once status['modified'] is set; before that only cached ones
+    are used, so a run skipped because nothing changed makes no TMDb
+    requests.
+    """
+    # Items waiting between two stages
+    queue_size = 200
+
+    def __init__(self, recipe, source_indexes=None, tmdb=None,
+                 status=None, workers=8, max_count=0):
+        self.recipe = recipe
+        self.source_indexes = source_indexes
+        self.tmdb = tmdb
+        self.status = status
+        self.max_count = max_count
+        # Number of the items added so far that matched
+        self.count = 0
+        # {tmdb_id: details or None}
+        self.details = {}
+        # {list item: source library items}
+        self.matches = {}
+        self._lock = threading.Lock()
+        self._errors = []
+        self._enrich_queue = queue.Queue(self.queue_size)
+        self._match_queue = queue.Queue(self.queue_size)
+        self._enrichers = [
+            threading.Thread(target=self._enrich_worker)
+            for i in range(workers if tmdb is not None else 1)]
+        self._matcher = threading.Thread(target=self._match_worker)
+        for thread in self._enrichers + [self._matcher]:
+            thread.daemon = True
+            thread.start()
+
+    @property
+    def done(self):
+        return self.max_count > 0 and self.count >= self.max_count
+
+    def __call__(self, item_list):
+        item = item_list[-1]
+        if self.max_count > 0 and self.match(item):
+            # Needed right away to know when to stop reading
+            self.count += 1
+        self._enrich_queue.put(item)
+        return self.done
+
+    def _enrich(self, item):
+        with self._lock:
+            if item.tmdb_id in self.details:
+                return
+            # Claimed, so other workers don't fetch it too
+            self.details[item.tmdb_id] = None
+        cached_only = self.status is not None \
+            and not self.status['modified']
+        try:
+            details = self.tmdb.get_details(item.tmdb_id,
+                                            self.recipe.library_type,
+                                            cached_only=cached_only)
+        except Exception as e:
+            # Only this item goes without details, as in
+            # TMDb.iter_details
+            print(u"Unable to get the TMDb details of {tmdb_id}: "
+                  u"{e}".format(tmdb_id=item.tmdb_id, e=e))
+            details = None
+            cached_only = False
+        with self._lock:
+            if details is None and cached_only:
+                # Left for weighted sorting to fetch if needed
+                del self.details[item.tmdb_id]
+            else:
+                self.details[item.tmdb_id] = details
+
+    def _enrich_worker(self):
+        while True:
+            item = self._enrich_queue.get()
+            if item is _DONE:
+                return
+            if self.tmdb is not None and item.tmdb_id \
+                    and not self._errors:
+                try:
+                    self._enrich(item)
+                except Exception as e:
+                    # Keep draining the queue, close() raises it
+                    self._errors.append(e)
+            self._match_queue.put(item)
+
+    def _match_worker(self):
+        while True:
+            item = self._match_queue.get()
+            if item is _DONE:
+                return
+            if self.source_indexes is None or self._errors \
+                    or item in self.matches:
+                continue
+            try:
+                self.matches[item] = self.recipe._match(
+                    item, self.source_indexes)
+            except Exception as e:
+                self._errors.append(e)
+
+    def match(self, item):
+        """Return the source library items matching a list item"""
+        if item not in self.matches:
+            self.matches[item] = self.recipe._match(item,
+                                                    self.source_indexes)
+        return self.matches[item]
+
+    def close(self):
+        """Wait for the queued items, raising the first error"""
+        for thread in self._enrichers:
+            self._enrich_queue.put(_DONE)
+        for thread in self._enrichers:
+            thread.join()
+        self._match_queue.put(_DONE)
+        self._matcher.join()
+        if self._errors:
+            raise self._errors[0]
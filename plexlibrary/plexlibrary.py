@@ -17,9 +17,13 @@ Credit:
 
 import argparse
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import recipes
-from recipe import Recipe
+from clients import Clients
+from daemon import Daemon
+from recipe import Recipe, run_recipe
+from runplan import RunPlan
 
 
 def list_recipes(directory=None):
@@ -28,20 +32,53 @@ def list_recipes(directory=None):
         print("    {}".format(name))
 
 
+def run_recipes(names, sort_only=False, workers=1, config_file=None,
+                scan=False):
+    """Run several recipes with shared clients
+
+    Returns the names of the recipes that failed.
+    """
+    clients = Clients(config_file)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        results = executor.map(
+            lambda name: run_recipe(name, clients, sort_only, scan), names)
+        return [name for name, ok in zip(names, list(results)) if not ok]
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog='plexlibrary',
         description=("This utility creates or maintains a Plex library "
                      "based on a configuration recipe."),
-        usage='%(prog)s [options] [<recipe>]',
+        usage=('%(prog)s [options] [<recipe> ...]\n'
+               '       %(prog)s [options] daemon [<recipe> ...]\n'
+               '       %(prog)s --plan <file> <recipe>\n'
+               '       %(prog)s --apply <file>'),
     )
-    parser.add_argument('recipe', nargs='?',
-                        help='Create a library using this recipe')
+    parser.add_argument('recipes', nargs='*', metavar='recipe',
+                        help=('Create a library using this recipe, or '
+                              '"daemon" to keep running the recipes on '
+                              'their interval'))
     parser.add_argument(
         '-l', '--list-recipes', action='store_true',
         help='list available recipes')
+    parser.add_argument(
+        '-a', '--all', action='store_true', help='run all recipes')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=1,
+        help='number of recipes to run at the same time (default: 1)')
     parser.add_argument(
         '-s', '--sort-only', action='store_true', help='only sort the library')
+    parser.add_argument(
+        '--scan', action='store_true',
+        help='with --sort-only, scan the library before sorting it')
+    parser.add_argument(
+        '-p', '--plan', metavar='FILE',
+        help=('save the changes a run would make to FILE, working out '
+              'them from cached data only, without changing anything'))
+    parser.add_argument(
+        '--apply', metavar='FILE',
+        help='make the changes of a plan saved with --plan')
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -52,13 +89,50 @@ def main():
         list_recipes()
         sys.exit(0)
 
-    if args.recipe not in recipes.get_recipes():
+    if args.apply:
+        run_plan = RunPlan.load(args.apply)
+        Recipe(run_plan.recipe_name).apply(run_plan)
+        print("Done!")
+        sys.exit(0)
+
+    daemon_mode = args.recipes[:1] == ['daemon']
+    if daemon_mode:
+        args.recipes = args.recipes[1:]
+        # No names for all recipes, including new ones
+        args.all = args.all or not args.recipes
+
+    available = recipes.get_recipes()
+    names = available if args.all else args.recipes
+    unknown = [name for name in names if name not in available]
+    if (not names and not daemon_mode) or unknown:
         print("Error: No such recipe")
         list_recipes()
         sys.exit(1)
 
-    r = Recipe(args.recipe)
-    r.run(args.sort_only)
+    if args.plan:
+        if len(names) != 1:
+            print("Error: Plan one recipe at a time")
+            sys.exit(1)
+        Recipe(names[0], clients=Clients(offline=True)).plan(args.plan)
+        sys.exit(0)
+
+    if daemon_mode:
+        clients = Clients()
+        daemon_config = clients.config.get('daemon') or {}
+        Daemon(clients, None if args.all else names, args.workers,
+               status_file=daemon_config.get('status_file'),
+               default_interval=daemon_config.get('interval')).run_forever()
+        sys.exit(0)
+
+    if len(names) == 1:
+        r = Recipe(names[0])
+        r.run(args.sort_only, args.scan)
+    else:
+        failed = run_recipes(names, args.sort_only, args.workers,
+                             scan=args.scan)
+        if failed:
+            print("Failed recipes: {}".format(", ".join(failed)))
+            sys.exit(1)
 
     print("Done!")
 
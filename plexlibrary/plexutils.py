@@ -1,19 +1,320 @@
 # -*- coding: utf-8 -*-
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlencode
+
 import plexapi.server
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    # Needed by plexapi's alert listener
+    import websocket
+except ImportError:
+    websocket = None
+
+# (source, prefix) pairs for the legacy agent guids
+# ("com.plexapp.agents.imdb://tt0111161?lang=en") and the Guid tags of the
+# new Plex agents ("imdb://tt0111161"). thetvdb must be tried before tvdb.
+GUID_PREFIXES = (
+    ('imdb', 'imdb://'),
+    ('tmdb', 'themoviedb://'),
+    ('tmdb', 'tmdb://'),
+    ('tvdb', 'thetvdb://'),
+    ('tvdb', 'tvdb://'),
+)
+
+
+def parse_guid(guid):
+    """Return the (source, id) pair of a Plex guid, or (None, None)"""
+    if not guid:
+        return None, None
+    if guid.startswith('plex://'):
+        return 'plex', guid
+    for source, prefix in GUID_PREFIXES:
+        if prefix in guid:
+            return source, guid.split(prefix)[1].split('?')[0].split('/')[0]
+    return None, None
+
+
+def guid_key(source, value):
+    """Return the item_ids style key of an id ('tt123', 'tmdb123', ...)"""
+    if not value:
+        return None
+    if source in ('tmdb', 'tvdb'):
+        return source + str(value)
+    return str(value)
+
+
+def guid_ids(guids):
+    """Return a {source: id} dict of the first imdb/tmdb/tvdb/plex ids"""
+    ids = {}
+    for guid in guids:
+        source, value = parse_guid(guid)
+        if source and source not in ids:
+            ids[source] = value
+    return ids
+
+
+def sort_title(number, title, title_format, visible=False):
+    """Return the (title, titleSort) of the item at a position"""
+    title_sort = title_format.format(number=str(number).zfill(6),
+                                     title=title)
+    if visible:
+        title = title_format.format(number=str(number), title=title)
+    return title, title_sort
+
+
+def element_record(element):
+    """Return a plain dict of the Plex item described by an XML element"""
+    guids = [element.attrib['guid']] if element.attrib.get('guid') else []
+    guids += [g.attrib['id'] for g in element.findall('Guid')]
+    year = element.attrib.get('year')
+    return {
+        'ratingKey': element.attrib['ratingKey'],
+        'guids': guids,
+        'title': element.attrib.get('title'),
+        'titleSort': element.attrib.get('titleSort'),
+        'year': int(year) if year else None,
+        'originallyAvailableAt': element.attrib.get('originallyAvailableAt'),
+        'files': [p.attrib['file'] for p in element.iter('Part')
+                  if p.attrib.get('file')],
+        'locations': [location.attrib['path']
+                      for location in element.findall('Location')],
+        'addedAt': int(element.attrib.get('addedAt') or 0),
+        'updatedAt': int(element.attrib.get('updatedAt') or 0),
+    }
+
+
+class GuidIndex(object):
+    """In-memory index of library items by their imdb/tmdb/tvdb ids
+
+    Keys follow the item_ids convention used by traktutils, plus the
+    'plex://' guids of the new Plex agents.
+    """
+
+    def __init__(self):
+        self._items = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item, guids):
+        for guid in guids:
+            key = guid_key(*parse_guid(guid))
+            if not key:
+                continue
+            items = self._items.setdefault(key, [])
+            if not any(i is item for i in items):
+                items.append(item)
+
+    def get(self, key):
+        return self._items.get(key, [])
+
+    def lookup(self, imdb_id=None, tmdb_id=None, tvdb_id=None):
+        """Return the items matching the first of imdb, tmdb, tvdb id
+        that exists in the index
+        """
+        for key in (guid_key('imdb', imdb_id), guid_key('tmdb', tmdb_id),
+                    guid_key('tvdb', tvdb_id)):
+            if key and key in self._items:
+                return list(self._items[key])
+        return []
+
+
+class ScanWaiter(object):
+    """Waits for library scans to finish
+
+    Listens to Plex's notification websocket, through plexapi's alert
+    listener, for the scan activities of each section. Start it before
+    triggering a scan so short scans aren't missed:
+
+        with ScanWaiter(plex) as waiter:
+            section.update()
+            waiter.wait(section)
+
+    The section's refreshing flag is polled as well, in case the listener
+    can't connect or misses a notification. Without websocket-client that
+    is all there is to go by.
+    """
+    activities = ('library.update.section', 'library.refresh.items')
+    poll_interval = 5
+    # Seconds without notifications before polling is trusted
+    quiet_period = 30
+    timeout = 4 * 3600
+
+    def __init__(self, plex, timeout=None):
+        self.plex = plex
+        if timeout:
+            self.timeout = timeout
+        self.listener = None
+        self._cond = threading.Condition()
+        # {section id: uuids of the running activities}
+        self._running = {}
+        # {section id: number of scans that ended}
+        self._scans = {}
+        self._last_event = {}
+        self._started = time.monotonic()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._started = time.monotonic()
+        if websocket is None or self.listener is not None:
+            return
+        try:
+            self.listener = self.plex.server.startAlertListener(self._alert)
+        except Exception as e:
+            print(u"Unable to listen for Plex notifications, polling "
+                  u"instead: {e}".format(e=e))
+
+    def stop(self):
+        if self.listener is None:
+            return
+        try:
+            self.listener.stop()
+        except Exception:
+            # Never connected
+            pass
+        self.listener = None
+
+    def _alert(self, data):
+        if data.get('type') != 'activity':
+            return
+        with self._cond:
+            for notification in data.get('ActivityNotification', []):
+                activity = notification.get('Activity', {})
+                if activity.get('type') not in self.activities:
+                    continue
+                section_id = str(activity.get('Context', {}).get(
+                    'librarySectionID'))
+                running = self._running.setdefault(section_id, set())
+                if notification.get('event') == 'ended':
+                    running.discard(activity.get('uuid'))
+                    if activity['type'] == 'library.update.section':
+                        self._scans[section_id] = \
+                            self._scans.get(section_id, 0) + 1
+                else:
+                    running.add(activity.get('uuid'))
+                self._last_event[section_id] = time.monotonic()
+            self._cond.notify_all()
+
+    def _refreshing(self, section):
+        # Queried directly, plexapi may have cached the sections
+        data = self.plex.server.query('/library/sections')
+        for element in data:
+            if element.attrib.get('key') == str(section.key):
+                return element.attrib.get('refreshing') == '1'
+        return False
+
+    def wait(self, section, scans=1):
+        """Block until the section has finished scanning
+
+        scans is the number of scans that were triggered, e.g. one per
+        path of a partial scan. Returns False if it's still scanning after
+        the timeout.
+        """
+        section_id = str(section.key)
+        deadline = self._started + self.timeout
+        while True:
+            with self._cond:
+                if self._scans.get(section_id, 0) >= scans \
+                        and not self._running.get(section_id):
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print(u"Gave up waiting for the '{library}' library "
+                          u"scan to finish.".format(library=section.title))
+                    return False
+                self._cond.wait(min(self.poll_interval, remaining))
+                if self._running.get(section_id):
+                    continue
+                quiet = time.monotonic() - self._last_event.get(
+                    section_id, self._started)
+            if (self.listener is None or quiet >= self.quiet_period) \
+                    and not self._refreshing(section):
+                return True
 
 
 class Plex(object):
+    # Concurrent metadata edits, also the size of the connection pool
+    max_workers = 8
+
     def __init__(self, baseurl, token):
         self.baseurl = baseurl
         self.token = token
+        self.session = requests.Session()
+        self.session.headers['X-Plex-Token'] = token
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         try:
+            # Through the pooled session, so its requests are counted too
             self.server = plexapi.server.PlexServer(
-                baseurl=baseurl, token=token)
+                baseurl=baseurl, token=token, session=self.session)
         except:
             raise Exception("No Plex server found at: {base_url}".format(
                 base_url=self.config['plex']['baseurl']))
 
+    def section_records(self, section_key, **filters):
+        """Return the items of a library section as plain dicts
+
+        Extra keyword arguments are passed as Plex filters, e.g.
+        ``**{'updatedAt>>': 1514764800}``.
+        """
+        params = {'includeGuids': 1}
+        params.update(filters)
+        key = '/library/sections/{key}/all?{query}'.format(
+            key=section_key, query=urlencode(params))
+        data = self.server.query(key)
+        if data is None:
+            return []
+        return [element_record(e) for e in data
+                if e.attrib.get('ratingKey')]
+
+    def section_size(self, section_key):
+        """Return the number of items in a library section"""
+        key = '/library/sections/{key}/all'.format(key=section_key)
+        data = self.server.query(key, headers={
+            'X-Plex-Container-Start': '0',
+            'X-Plex-Container-Size': '0',
+        })
+        return int(data.attrib.get('totalSize') or data.attrib.get('size'))
+
+    def first_episode_file(self, rating_key):
+        """Return the file of the first episode of a show, or None"""
+        key = '/library/metadata/{key}/allLeaves'.format(key=rating_key)
+        data = self.server.query(key, headers={
+            'X-Plex-Container-Start': '0',
+            'X-Plex-Container-Size': '1',
+        })
+        if data is None:
+            return None
+        for part in data.iter('Part'):
+            if part.attrib.get('file'):
+                return part.attrib['file']
+        return None
+
+    def section_titles(self, section_key):
+        """Return {ratingKey: (title, titleSort)} for a library section
+
+        titleSort is None for items that don't have one set.
+        """
+        key = '/library/sections/{key}/all'.format(key=section_key)
+        data = self.server.query(key)
+        if data is None:
+            return {}
+        return dict((e.attrib['ratingKey'],
+                     (e.attrib.get('title'), e.attrib.get('titleSort')))
+                    for e in data if e.attrib.get('ratingKey'))
+
     def create_new_library(self, name, folder, library_type='movie'):
         headers = {"X-Plex-Token": self.token}
         params = {
@@ -33,31 +334,111 @@ class Plex(object):
             raise Exception("Library type should be 'movie' or 'tv'")
 
         url = '{base_url}/library/sections'.format(base_url=self.baseurl)
-        requests.post(url, headers=headers, params=params)
+        self.session.post(url, headers=headers, params=params)
+        # Newer plexapi versions cache the list of library sections
+        self.server = plexapi.server.PlexServer(
+            baseurl=self.baseurl, token=self.token, session=self.session)
 
-    def set_sort_title(self, library_key, rating_key, number, title,
-                       library_type, title_format, visible=False):
-        headers = {'X-Plex-Token': self.token}
+    def sort_title_params(self, rating_key, number, title, library_type,
+                          title_format, visible=False):
+        """Return the edit parameters that set an item's sort title"""
         if library_type == 'movie':
             search_type = 1
         elif library_type == 'tv':
             search_type = 2
-        params = {
+        else:
+            raise Exception("Library type should be 'movie' or 'tv'")
+        title, title_sort = sort_title(number, title, title_format, visible)
+        return {
             'type': search_type,
             'id': rating_key,
-            'titleSort.value': title_format.format(
-                number=str(number).zfill(6), title=title),
+            'titleSort.value': title_sort,
             'titleSort.locked': 1,
+            'title.value': title,
+            'title.locked': 1 if visible else 0,
         }
 
-        if visible:
-            params['title.value'] = title_format.format(
-                number=str(number), title=title)
-            params['title.locked'] = 1
-        else:
-            params['title.value'] = title
-            params['title.locked'] = 0
-
+    def edit_items(self, library_key, params):
+        """Send an edit for items of a library section"""
         url = "{base_url}/library/sections/{library}/all".format(
                 base_url=self.baseurl, library=library_key)
-        requests.put(url, headers=headers, params=params)
+        r = self.session.put(url, params=params, timeout=30)
+        r.raise_for_status()
+        return r
+
+    def set_sort_title(self, library_key, rating_key, number, title,
+                       library_type, title_format, visible=False):
+        self.edit_items(library_key, self.sort_title_params(
+            rating_key, number, title, library_type, title_format, visible))
+
+
+class SortTitleWriter(object):
+    """Collect the sort titles of a library and write only the changes
+
+    The current titles are read with a single listing of the section when
+    the writer is created, unless they are passed as current, a
+    {ratingKey: (title, titleSort)} dict. Queued edits are sent
+    concurrently by flush().
+    """
+    max_retries = 3
+
+    def __init__(self, plex, library_key, library_type, title_format,
+                 visible=False, max_workers=None, current=None):
+        self.plex = plex
+        self.library_key = library_key
+        self.library_type = library_type
+        self.title_format = title_format
+        self.visible = visible
+        self.max_workers = max_workers or plex.max_workers
+        if current is None:
+            current = plex.section_titles(library_key)
+        self.current = current
+        self.edits = []
+        self.sent = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def set(self, rating_key, number, title):
+        """Queue a sort title, unless the item already has it"""
+        params = self.plex.sort_title_params(
+            rating_key, number, title, self.library_type, self.title_format,
+            self.visible)
+        current = self.current.get(str(rating_key))
+        if current == (params['title.value'], params['titleSort.value']):
+            self.skipped += 1
+        else:
+            self.edits.append(params)
+
+    def _send(self, params):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.plex.edit_items(self.library_key, params)
+            except requests.RequestException as e:
+                response = getattr(e, 'response', None)
+                if attempt == self.max_retries or (
+                        response is not None and response.status_code < 500):
+                    raise
+                time.sleep(2 ** attempt)
+
+    def flush(self):
+        """Send the queued edits and return the number sent"""
+        edits, self.edits = self.edits, []
+        sent = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = dict((executor.submit(self._send, params), params)
+                           for params in edits)
+            for future in as_completed(futures):
+                params = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    self.failed += 1
+                    print(u"Setting the sort title failed for "
+                          u"{title}: {e}".format(
+                            title=params['title.value'], e=e))
+                    continue
+                sent += 1
+                self.current[str(params['id'])] = (
+                    params['title.value'], params['titleSort.value'])
+        self.sent += sent
+        return sent
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""ratelimit
+
+Rate limiting for the web APIs, shared between worker threads
+"""
+
+import collections
+import threading
+import time
+
+
+class RateLimiter(object):
+    """Sliding window limiter allowing `rate` calls per `period` seconds"""
+
+    def __init__(self, rate, period=1.0):
+        self.rate = rate
+        self.period = float(period)
+        self._calls = collections.deque()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until another call is allowed and reserve it"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and self._calls[0] <= now - self.period:
+                    self._calls.popleft()
+                delay = self._blocked_until - now
+                if len(self._calls) >= self.rate:
+                    delay = max(delay, self._calls[0] + self.period - now)
+                if delay <= 0:
+                    self._calls.append(now)
+                    return
+            time.sleep(delay)
+
+    def block(self, seconds):
+        """Hold back all calls for a while, e.g. to honour Retry-After"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until,
+                                      time.monotonic() + seconds)
+
+
+def retry_after(response, default=10):
+    """Return the seconds to wait from a 429 response"""
+    try:
+        return max(int(response.headers.get('Retry-After', default)), 1)
+    except ValueError:
+        # HTTP-date values aren't used by the APIs we talk to
+        return default
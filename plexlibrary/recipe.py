@@ -3,21 +3,23 @@
 """
 
 import datetime
-import errno
+import hashlib
+import itertools
+import json
 import os
-import random
-import subprocess
-import sys
 import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-import plexapi
-
+import metrics
 import plexutils
-import tmdb
-import traktutils
-import tvdb
-from config import ConfigParser
+import symlinks
+import weighting
+from clients import Clients
+from mediaitem import ItemCollection
+from pipeline import ItemPipeline
 from recipes import RecipeParser
+from runplan import RunPlan
 from utils import Colors, add_years
 
 
@@ -26,12 +28,18 @@ class Recipe(object):
     trakt = None
     tmdb = None
     tvdb = None
+    crosswalk = None
+    # Metrics of the last run, see metrics.Metrics.since
+    run_metrics = None
 
-    def __init__(self, recipe_name, sort_only=False, config_file=None):
+    def __init__(self, recipe_name, sort_only=False, config_file=None,
+                 clients=None, recipe_directory=None):
         self.recipe_name = recipe_name
 
-        self.config = ConfigParser(config_file)
-        self.recipe = RecipeParser(recipe_name)
+        # Clients can be shared with other recipes
+        self.clients = clients or Clients(config_file)
+        self.config = self.clients.config
+        self.recipe = RecipeParser(recipe_name, recipe_directory)
 
         if self.recipe['library_type'].lower().startswith('movie'):
             self.library_type = 'movie'
@@ -41,72 +49,446 @@ class Recipe(object):
             raise Exception("Library type should be 'movie' or 'tv'")
 
         self.source_library_config = self.recipe['source_libraries']
+        # Timings of the phases of the current run
+        self.phases = metrics.PhaseTimer()
 
-        self.plex = plexutils.Plex(self.config['plex']['baseurl'],
-                                   self.config['plex']['token'])
+        self.plex = self.clients.plex
+        self.crosswalk = self.clients.crosswalk
 
         if self.config['trakt']['username']:
-            self.trakt = traktutils.Trakt(
-                self.config['trakt']['username'],
-                client_id=self.config['trakt']['client_id'],
-                client_secret=self.config['trakt']['client_secret'],
-                oauth_token=self.config['trakt'].get('oauth_token', ''),
-                oauth=self.recipe.get('trakt_oauth', False))
-            if self.trakt.oauth_token:
-                self.config['trakt']['oauth_token'] = self.trakt.oauth_token
+            self.trakt = self.clients.trakt(
+                self.recipe.get('trakt_oauth', False))
 
         if self.config['tmdb']['api_key']:
-            self.tmdb = tmdb.TMDb(
-                self.config['tmdb']['api_key'],
-                cache_file=self.config['tmdb']['cache_file'])
+            self.tmdb = self.clients.tmdb
 
         if self.config['tvdb']['username']:
-            self.tvdb = tvdb.TheTVDB(self.config['tvdb']['username'],
-                                     self.config['tvdb']['api_key'],
-                                     self.config['tvdb']['user_key'])
-
-    def _run(self):
-        item_list = []  # TODO Replace with dict, scrap item_ids?
-        item_ids = []
-        force_imdb_id_match = False
-
-        # Get the trakt lists
-        for url in self.recipe['source_list_urls']:
-            if 'api.trakt.tv' in url:
-                (item_list, item_ids) = self.trakt.add_items(
-                    self.library_type, url, item_list, item_ids,
-                    self.recipe['new_library']['max_age'] or 0)
+            self.tvdb = self.clients.tvdb
+
+    def _snapshot(self, section):
+        """Return an up to date snapshot of a library section"""
+        return self.clients.snapshot(section, max_age=0)
+
+    def _scan_waiter(self):
+        return plexutils.ScanWaiter(
+            self.plex, self.config['plex'].get('scan_timeout'))
+
+    def _scan_paths(self, reconciler, changed):
+        """Return the folders of the new library that need a scan
+
+        These are the changed links and the links of source items
+        updated since the last run. Returns None when a full scan is
+        needed instead.
+        """
+        last_run_state = self._last_run_state()
+        if not last_run_state:
+            return None
+        # The new library itself comes last
+        watermark = min([w for uuid, w, size
+                         in last_run_state['libraries'][:-1]] or [0])
+        changed = set(changed)
+        for rel_path, (target, is_dir, item) in reconciler.desired.items():
+            if max(item['addedAt'], item['updatedAt']) >= watermark:
+                changed.add(rel_path)
+        scan_paths = symlinks.coalesce(changed)
+        limit = self.config['plex'].get('partial_scan_limit', 20)
+        if not limit or scan_paths is None or len(scan_paths) > limit:
+            return None
+        return scan_paths
+
+    def _movie_link(self, old_path_file):
+        """Return the (path, target, is_dir) link of a movie file"""
+        old_path, file_name = os.path.split(old_path_file)
+        for library_config in self.source_library_config:
+            for f in library_config['folders']:
+                f = os.path.abspath(f)
+                if old_path.lower().startswith(f.lower()):
+                    folder_name = os.path.relpath(old_path, f)
+                    if folder_name == '.':
+                        return file_name, old_path_file, False
+                    return folder_name, old_path, True
+        return None
+
+    def _source_links(self, item, episode_file=None):
+        """Return the (path, target, is_dir) links for a source item
+
+        Paths are relative to the new library folder. Shows are linked by
+        their root folder, taken from the show's locations or else from
+        the path of one of its episodes.
+        """
+        links = []
+        if self.library_type == 'movie':
+            # Every part, e.g. of multi-part movies and other versions
+            seen = set()
+            for old_path_file in item['files']:
+                link = self._movie_link(old_path_file)
+                if link is not None and link[0] not in seen:
+                    seen.add(link[0])
+                    links.append(link)
+            return links
+
+        if episode_file:
+            paths = [os.path.dirname(episode_file)]
+        else:
+            paths = item.get('locations') or []
+        for old_path in paths:
+            for library_config in self.source_library_config:
+                for f in library_config['folders']:
+                    if old_path.lower().startswith(f.lower()):
+                        folder_name = old_path.replace(f, '').strip(
+                            os.sep).split(os.sep)[0]
+                        links.append((folder_name,
+                                      os.path.join(f, folder_name), True))
+                        return links
+        return links
+
+    def _all_source_links(self, items):
+        """Yield (item, links) for many source items
+
+        Shows without a known location are looked up concurrently, one
+        episode each. Offline they are left without links.
+        """
+        lookups = []
+        for item in items:
+            links = self._source_links(item)
+            if links or self.library_type == 'movie':
+                yield item, links
+            else:
+                lookups.append(item)
+        if not lookups:
+            return
+        if self.plex is None:
+            print(u"Warning: No location known for {count} shows, they "
+                  u"can't be linked offline".format(count=len(lookups)))
+            for item in lookups:
+                yield item, []
+            return
+        with ThreadPoolExecutor(
+                max_workers=self.plex.max_workers) as executor:
+            episode_files = executor.map(
+                lambda item: self.plex.first_episode_file(item['ratingKey']),
+                lookups)
+            for item, episode_file in zip(lookups, episode_files):
+                yield item, self._source_links(item, episode_file)
+
+    def _removals(self, reconciler, records):
+        """Return {path: item} of the symlinks that no longer qualify
+
+        Unless remove_from_library is set, only the links of movies older
+        than max_age qualify for removal, and those of all shows.
+        """
+        remove_all = self.recipe['new_library']['remove_from_library']
+        max_age = self.recipe['new_library']['max_age']
+        max_date = add_years((max_age or 0) * -1)
+        removals = {}
+        if remove_all:
+            # Including links Plex hasn't picked up (yet)
+            removals = dict((rel_path, None)
+                            for rel_path in reconciler.existing)
+        for record in records:
+            if not remove_all and self.library_type == 'movie':
+                # Only remove older than max_age
+                if not max_age or not record['originallyAvailableAt'] \
+                        or (max_date < datetime.datetime.strptime(
+                            record['originallyAvailableAt'], '%Y-%m-%d')):
+                    continue
+            for path in record['files'] + record['locations']:
+                rel_path = reconciler.link_for(path)
+                if rel_path is not None:
+                    removals[rel_path] = record
+        return dict((rel_path, item) for rel_path, item in removals.items()
+                    if rel_path not in reconciler.desired)
+
+    def _imdb_map(self, records, item_list, force_imdb_id_match=False):
+        """Create a dictionary of {imdb_id: item} for new library items"""
+        imdb_map = {}
+        unmatched = []
+        for m in records:
+            ids = plexutils.guid_ids(m['guids'])
+            imdb_id = ids.get('imdb')
+            tmdb_id = ids.get('tmdb')
+            tvdb_id = ids.get('tvdb')
+
+            key = self._list_key(item_list, ids)
+            if key is None and self.crosswalk is not None:
+                # Try the other known ids of the item
+                ids = self.crosswalk.ids(self.library_type, imdb_id,
+                                         tmdb_id, tvdb_id)
+                key = self._list_key(item_list, ids)
+            if key is not None:
+                imdb_map[key] = m
+            elif force_imdb_id_match and not ids.get('imdb'):
+                # Look up the IMDb ID as a last resort
+                unmatched.append((m, imdb_id, tmdb_id, tvdb_id))
             else:
+                imdb_map[m['ratingKey']] = m
+
+        # Only IMDB ID found for some items
+        tvdb_imdb_ids = {}
+        tvdb_ids = [tvdb_id for m, imdb_id, tmdb_id, tvdb_id in unmatched
+                    if tvdb_id and not tmdb_id]
+        if tvdb_ids and self.tvdb:
+            tvdb_imdb_ids = self.tvdb.get_imdb_ids(tvdb_ids)
+        for m, imdb_id, tmdb_id, tvdb_id in unmatched:
+            if tmdb_id:
+                imdb_id = self.tmdb.get_imdb_id(tmdb_id, self.library_type)
+            elif tvdb_id:
+                imdb_id = tvdb_imdb_ids.get(tvdb_id)
+            if imdb_id and str(imdb_id) in item_list:
+                imdb_map[imdb_id] = m
+            else:
+                imdb_map[m['ratingKey']] = m
+            if imdb_id and self.crosswalk is not None:
+                self.crosswalk.add(self.library_type, {
+                    'imdb': imdb_id, 'tmdb': tmdb_id, 'tvdb': tvdb_id})
+        if unmatched and self.crosswalk is not None:
+            self.crosswalk.flush()
+        return imdb_map
+
+    def _list_key(self, item_list, ids):
+        """Return the key of the first of the ids found in the item list"""
+        for source in ('imdb', 'tmdb', 'tvdb'):
+            key = plexutils.guid_key(source, ids.get(source))
+            if key and key in item_list:
+                return key
+        return None
+
+    def _pop_match(self, imdb_map, m):
+        """Pop the new library item of a list item from the imdb_map"""
+        for key in m.keys:
+            item = imdb_map.pop(key, None)
+            if item:
+                return item
+        return None
+
+    def _sort_titles(self, item_list, imdb_map, sort=True, leftovers=True):
+        """Yield (ratingKey, number, title) for the new library items
+
+        The matches of the list items are popped from the imdb_map (see
+        _imdb_map). With leftovers, the other items follow the list.
+        """
+        i = 0
+        if self.recipe['new_library']['sort_title']['absolute']:
+            for i, m in enumerate(item_list):
+                item = self._pop_match(imdb_map, m)
+                if item and sort:
+                    yield item['ratingKey'], i+1, m.title
+        else:
+            for m in item_list:
+                item = self._pop_match(imdb_map, m)
+                if item and sort:
+                    i += 1
+                    yield item['ratingKey'], i, m.title
+
+        if leftovers:
+            while imdb_map:
+                imdb_id, item = imdb_map.popitem()
+                i += 1
+                yield item['ratingKey'], i, item['title']
+
+    def _remove_enabled(self):
+        return bool(self.recipe['new_library']['remove_from_library']
+                    or self.recipe['new_library'].get('remove_old', False))
+
+    def _get_source_lists(self, enough=None, status=None):
+        """Fetch the source lists concurrently and merge them in order
+
+        Reading stops as soon as `enough` (see traktutils.add_items)
+        returns True. status['modified'] is set if any list changed since
+        it was cached.
+        """
+        item_list = ItemCollection()
+        max_age = self.recipe['new_library']['max_age'] or 0
+        urls = self.recipe['source_list_urls']
+        for url in urls:
+            if 'api.trakt.tv' not in url:
                 raise Exception("Unsupported source list: {url}".format(
                     url=url))
 
-        if self.recipe['weighted_sorting']['enabled']:
-            if self.config['tmdb']['api_key']:
-                print(u"Getting data from TMDb to add weighted sorting...")
-                item_list = self.weighted_sorting(item_list)
-            else:
-                print(u"Warning: TMDd API key is required "
-                      u"for weighted sorting")
+        lists = self.trakt.iter_lists(urls, max_age, status)
+        try:
+            for url, data in lists:
+                item_list = self.trakt.add_items(
+                    self.library_type, url, item_list, max_age, data=data,
+                    enough=enough)
+                if enough and enough.done:
+                    print(u"Found enough items, skipping the rest of the "
+                          u"lists")
+                    break
+        finally:
+            lists.close()
+        return item_list
 
-        # Get list of items from the Plex server
-        source_libraries = []
+    def _get_source_snapshots(self):
+        """Return up to date snapshots of the source libraries"""
+        source_snapshots = []
         for library_config in self.source_library_config:
             print(u"Trying to match with items from the '{}' library ".format(
                 library_config['name']))
-            try:
-                source_library = self.plex.server.library.section(
-                    library_config['name'])
-            except:  # FIXME
+            source_library = self.clients.section(library_config['name'])
+            if source_library is None:
                 raise Exception("The '{}' library does not exist".format(
                     library_config['name']))
 
-            # FIXME: Hack until a new plexapi version is released. 3.0.4?
-            if 'guid' not in source_library.ALLOWED_FILTERS:
-                source_library.ALLOWED_FILTERS += ('guid',)
+            # Shared with the other recipes
+            source_snapshots.append(self.clients.snapshot(source_library))
+        return source_snapshots
 
-            source_libraries.append(source_library)
+    def _run_state(self, source_snapshots, new_snapshot=None):
+        """Describe the recipe and the libraries it reads and writes
+
+        Returns None when there is nothing to compare against (no list
+        cache or no new library yet).
+        """
+        if not self.trakt.cache:
+            return None
+        if new_snapshot is None:
+            new_library = self.clients.section(
+                self.recipe['new_library']['name'])
+            if new_library is None:
+                return None
+            new_snapshot = self._snapshot(new_library)
+
+        recipe_hash = hashlib.sha1(json.dumps(
+            self.recipe.data, sort_keys=True, default=str).encode('utf-8'))
+        return {
+            'recipe': recipe_hash.hexdigest(),
+            'libraries': [
+                [s.section.uuid, s.watermark, len(s.items)]
+                for s in source_snapshots + [new_snapshot]],
+        }
+
+    def _last_run_state(self):
+        return self.trakt.cache.get('recipe', self.recipe_name, 'state')
+
+    def _save_run_state(self, run_state):
+        if run_state:
+            self.trakt.cache.put('recipe', self.recipe_name, 'state',
+                                 run_state)
+
+    def _sort_title_writer(self, library, records):
+        """Return a SortTitleWriter knowing the titles of the records"""
+        # Records saved before titleSort was kept get theirs written again
+        current = dict((r['ratingKey'], (r['title'], r.get('titleSort')))
+                       for r in records)
+        return plexutils.SortTitleWriter(
+            self.plex, library.key, self.library_type,
+            self.recipe['new_library']['sort_title']['format'],
+            self.recipe['new_library']['sort_title']['visible'],
+            current=current)
+
+    def _write_sort_titles(self, writer):
+        writer.flush()
+        self.clients.metrics.add_many(
+            ('sort_title_writes', count, {'result': result})
+            for result, count in (('sent', writer.sent),
+                                  ('skipped', writer.skipped),
+                                  ('failed', writer.failed)))
+        print(u"Sort titles: {sent} written, {skipped} already up to date"
+              u"{failed}.".format(
+                sent=writer.sent, skipped=writer.skipped,
+                failed=u", {} failed".format(writer.failed)
+                if writer.failed else u''))
+
+    def _match(self, item, source_indexes):
+        """Return the source library items matching a list item"""
+        res = []
+        for index in source_indexes:
+            res += index.lookup(imdb_id=item.id, tmdb_id=item.tmdb_id,
+                                tvdb_id=item.tvdb_id)
+        if res or self.crosswalk is None:
+            return res
+        # Try the other known ids of the item
+        ids = self.crosswalk.ids(self.library_type, item.id, item.tmdb_id,
+                                 item.tvdb_id)
+        # Trakt ids and slugs don't appear in Plex guids
+        if len([s for s in ('imdb', 'tmdb', 'tvdb')
+                if ids.get(s)]) > len(item.keys):
+            for index in source_indexes:
+                res += index.lookup(imdb_id=ids.get('imdb'),
+                                    tmdb_id=ids.get('tmdb'),
+                                    tvdb_id=ids.get('tvdb'))
+        return res
+
+    def _weighted_sorting_enabled(self):
+        return bool(self.recipe['weighted_sorting']['enabled']
+                    and self.config['tmdb']['api_key'])
+
+    def _pipeline(self, source_indexes=None, status=None):
+        """Return an ItemPipeline for reading the source lists
+
+        Without weighted sorting the list order is final, so with source
+        indexes the lists are only read until max_count items match.
+        """
+        if not self._weighted_sorting_enabled():
+            return ItemPipeline(
+                self, source_indexes,
+                max_count=self.recipe['new_library']['max_count']
+                if source_indexes is not None else 0)
+        return ItemPipeline(self, source_indexes, self.tmdb, status,
+                            workers=self.tmdb.max_workers)
+
+    def _run(self):
+        """Run the recipe, returning None if nothing changed since the
+        last run, or else the missing items and the new library size
+        """
+        source_snapshots = []
+        run_plan = self._plan(skip_unchanged=True,
+                              source_snapshots=source_snapshots)
+        if run_plan is None:
+            return None
+        return self._apply_plan(run_plan, source_snapshots)
+
+    def _plan(self, skip_unchanged=False, preview=False,
+              source_snapshots=None):
+        """Work out the changes of a run, without making any
+
+        Returns a RunPlan, or None if skip_unchanged is set and nothing
+        changed since the last run. With preview, the plan includes the
+        sort titles of the items already in the new library. The source
+        library snapshots are added to source_snapshots, if given.
+        """
+        force_imdb_id_match = self.recipe['new_library'].get(
+            'force_imdb_id_match', False)
+
+        self.phases.start('source_snapshots')
+        snapshots = self._get_source_snapshots()
+        if source_snapshots is not None:
+            source_snapshots.extend(snapshots)
+        # Index the items of the source libraries by their ids
+        source_indexes = [s.guid_index() for s in snapshots]
+
+        # TMDb details are fetched and the items matched while the lists
+        # are still being read
+        self.phases.start('source_lists')
+        list_status = {'modified': False}
+        pipeline = self._pipeline(source_indexes,
+                                  list_status if skip_unchanged else None)
+        try:
+            item_list = self._get_source_lists(pipeline, list_status)
+        finally:
+            pipeline.close()
+
+        if skip_unchanged:
+            run_state = self._run_state(snapshots)
+            if not list_status['modified'] and run_state \
+                    and run_state == self._last_run_state():
+                print(u"The source lists and libraries haven't changed "
+                      u"since the last run, skipping")
+                return None
+
+        self.phases.start('weighted_sorting')
+        if self.recipe['weighted_sorting']['enabled']:
+            if self.config['tmdb']['api_key']:
+                print(u"Getting data from TMDb to add weighted sorting...")
+                item_list = self.weighted_sorting(item_list,
+                                                  pipeline.details)
+            else:
+                print(u"Warning: TMDd API key is required "
+                      u"for weighted sorting")
 
         # Create a list of matching items
+        self.phases.start('matching')
         matching_items = []
         missing_items = []
         matching_total = 0
@@ -114,65 +496,78 @@ class Recipe(object):
         max_count = self.recipe['new_library']['max_count']
 
         for i, item in enumerate(item_list):
-            match = False
             if max_count > 0 and matching_total >= max_count:
                 nonmatching_idx.append(i)
                 continue
-            res = []
-            for source_library in source_libraries:
-                lres = source_library.search(guid='imdb://' + str(item['id']))
-                if not lres and item.get('tmdb_id'):
-                    lres += source_library.search(
-                        guid='themoviedb://' + str(item['tmdb_id']))
-                if not lres and item.get('tvdb_id'):
-                    lres += source_library.search(
-                        guid='thetvdb://' + str(item['tvdb_id']))
-                if lres:
-                    res += lres
+            res = pipeline.match(item)
             if not res:
                 missing_items.append((i, item))
                 nonmatching_idx.append(i)
                 continue
 
-            for r in res:
-                imdb_id = None
-                tmdb_id = None
-                tvdb_id = None
-                if r.guid is not None and 'imdb://' in r.guid:
-                    imdb_id = r.guid.split('imdb://')[1].split('?')[0]
-                elif r.guid is not None and 'themoviedb://' in r.guid:
-                    tmdb_id = r.guid.split('themoviedb://')[1].split('?')[0]
-                elif r.guid is not None and 'thetvdb://' in r.guid:
-                    tvdb_id = (r.guid.split('thetvdb://')[1]
-                               .split('?')[0]
-                               .split('/')[0])
-
-                if ((imdb_id and imdb_id == str(item['id']))
-                        or (tmdb_id and tmdb_id == str(item['tmdb_id']))
-                        or (tvdb_id and tvdb_id == str(item['tvdb_id']))):
-                    if not match:
-                        match = True
-                        matching_total += 1
-                    matching_items.append(r)
-
-            if match:
-                if self.recipe['new_library']['sort_title']['absolute']:
-                    print(u"{} {} ({})".format(
-                        i+1, item['title'], item['year']))
-                else:
-                    print(u"{} {} ({})".format(
-                        matching_total, item['title'], item['year']))
+            matching_total += 1
+            matching_items += res
+            if self.recipe['new_library']['sort_title']['absolute']:
+                print(u"{} {} ({})".format(
+                    i+1, item.title, item.year))
             else:
-                missing_items.append((i, item))
-                nonmatching_idx.append(i)
+                print(u"{} {} ({})".format(
+                    matching_total, item.title, item.year))
 
         if not self.recipe['new_library']['sort_title']['absolute']:
-            for i in reversed(nonmatching_idx):
-                del item_list[i]
+            item_list.remove_indices(nonmatching_idx)
+
+        # Work out the symlinks for all the matching items
+        self.phases.start('symlinks')
+        new_library = self.clients.section(self.recipe['new_library']['name'])
+        reconciler = symlinks.Reconciler(self.recipe['new_library']['folder'])
+        for item, links in self._all_source_links(matching_items):
+            for rel_path, target, is_dir in links:
+                reconciler.add(rel_path, target, is_dir, item)
+        reconciler.scan()
+
+        removals = {}
+        if self._remove_enabled() and new_library is not None:
+            removals = self._removals(
+                reconciler, self._snapshot(new_library).values())
+        run_plan = RunPlan(self.recipe_name, self.library_type, item_list,
+                           missing_items, reconciler,
+                           reconciler.plan(removals), removals)
+        run_plan.matched = matching_total
+
+        if preview and new_library is not None:
+            self.phases.start('sort_titles')
+            imdb_map = self._imdb_map(self._snapshot(new_library).values(),
+                                      item_list, force_imdb_id_match)
+            sort_title = self.recipe['new_library']['sort_title']
+            for rating_key, number, title in self._sort_titles(
+                    item_list, imdb_map, self.recipe['new_library']['sort'],
+                    not self._remove_enabled()):
+                run_plan.sort_titles.append(
+                    (rating_key,) + plexutils.sort_title(
+                        number, title, sort_title['format'],
+                        sort_title['visible']))
+        return run_plan
+
+    def _apply_plan(self, run_plan, source_snapshots=None):
+        """Make the changes of a plan, returning the missing items and
+        the new library size
+
+        The state of the run is saved for the next one when the source
+        library snapshots the plan was made from are given.
+        """
+        force_imdb_id_match = self.recipe['new_library'].get(
+            'force_imdb_id_match', False)
+        item_list = run_plan.item_list
+        reconciler = run_plan.reconciler
+        plan = run_plan.links
+        removals = run_plan.removals
+        remove = self._remove_enabled()
 
         # Create symlinks for all items in your library on the trakt watched
+        self.phases.start('symlinks')
         print(u"Creating symlinks for {count} matching items in the "
-              u"library...".format(count=matching_total))
+              u"library...".format(count=run_plan.matched))
 
         try:
             if not os.path.exists(self.recipe['new_library']['folder']):
@@ -182,520 +577,265 @@ class Recipe(object):
                   u"'{folder}'.".format(
                       folder=self.recipe['new_library']['folder']))
             print(u"Exiting script.")
-            return 0
-
-        count = 0
-        updated_paths = []
-        new_items = []
-        if self.library_type == 'movie':
-            for movie in matching_items:
-                for part in movie.iterParts():
-                    old_path_file = part.file
-                    old_path, file_name = os.path.split(old_path_file)
-
-                    folder_name = ''
-                    for library_config in self.source_library_config:
-                        for f in library_config['folders']:
-                            f = os.path.abspath(f)
-                            if old_path.lower().startswith(f.lower()):
-                                folder_name = os.path.relpath(old_path, f)
-                                break
-                        else:
-                            continue
-
-                        if folder_name == '.':
-                            new_path = os.path.join(
-                                self.recipe['new_library']['folder'],
-                                file_name)
-                            dir = False
-                        else:
-                            new_path = os.path.join(
-                                self.recipe['new_library']['folder'],
-                                folder_name)
-                            dir = True
-                            parent_path = os.path.dirname(
-                                os.path.abspath(new_path))
-                            if not os.path.exists(parent_path):
-                                try:
-                                    os.makedirs(parent_path)
-                                except OSError as e:
-                                    if e.errno == errno.EEXIST and \
-                                            os.path.isdir(parent_path):
-                                        pass
-                                    else:
-                                        raise
-                            # Clean up old, empty directories
-                            if (os.path.exists(new_path) and not
-                                    os.listdir(new_path)):
-                                os.rmdir(new_path)
-
-                        if (dir and not os.path.exists(new_path)) or \
-                                (not dir and not os.path.isfile(new_path)):
-                            try:
-                                if os.name == 'nt':
-                                    if dir:
-                                        subprocess.call(['mklink', '/D',
-                                                        new_path, old_path],
-                                                        shell=True)
-                                    else:
-                                        subprocess.call(['mklink', new_path,
-                                                        old_path_file],
-                                                        shell=True)
-                                else:
-                                    if dir:
-                                        os.symlink(old_path, new_path)
-                                    else:
-                                        os.symlink(old_path_file, new_path)
-                                count += 1
-                                new_items.append(movie)
-                                updated_paths.append(new_path)
-                            except Exception as e:
-                                print(u"Symlink failed for {path}: {e}".format(
-                                    path=new_path, e=e))
-        else:
-            for tv_show in matching_items:
-                done = False
-                if done:
-                    continue
-                for episode in tv_show.episodes():
-                    if done:
-                        break
-                    for part in episode.iterParts():
-                        old_path_file = part.file
-                        old_path, file_name = os.path.split(old_path_file)
-
-                        folder_name = ''
-                        for library_config in self.source_library_config:
-                            for f in library_config['folders']:
-                                if old_path.lower().startswith(f.lower()):
-                                    old_path = os.path.join(f,
-                                        old_path.replace(f, '').strip(
-                                            os.sep).split(os.sep)[0])
-                                    folder_name = os.path.relpath(old_path, f)
-                                    break
-                            else:
-                                continue
-
-                            new_path = os.path.join(
-                                self.recipe['new_library']['folder'],
-                                folder_name)
-
-                            if not os.path.exists(new_path):
-                                try:
-                                    if os.name == 'nt':
-                                        subprocess.call(['mklink', '/D',
-                                                        new_path, old_path],
-                                                        shell=True)
-                                    else:
-                                        os.symlink(old_path, new_path)
-                                    count += 1
-                                    new_items.append(tv_show)
-                                    updated_paths.append(new_path)
-                                    done = True
-                                    break
-                                except Exception as e:
-                                    print(u"Symlink failed for {path}: {e}"
-                                        .format(path=new_path, e=e))
-                            else:
-                                done = True
-                                break
-
-        print(u"Created symlinks for {count} new items:".format(count=count))
-        for item in new_items:
-            print(u"{title} ({year})".format(title=item.title, year=item.year))
+            return None
+
+        new_library = self.clients.section(self.recipe['new_library']['name'])
+
+        created, removed, errors, counts = reconciler.apply(
+            plan, self.recipe['new_library'].get('fs_workers') or 1)
+        counts['error'] = len(errors)
+        self.clients.metrics.add_many(
+            ('fs_operations', count, {'op': op})
+            for op, count in sorted(counts.items()))
+
+        print(u"Created symlinks for {count} new items:".format(
+            count=len(created)))
+        for rel_path in created:
+            item = reconciler.desired[rel_path][2]
+            print(u"{title} ({year})".format(title=item['title'],
+                                             year=item['year']))
+        if remove:
+            print(u"Removed symlinks for {count} items which no longer "
+                  u"qualify:".format(count=len(removed)))
+            for rel_path in removed:
+                item = removals[rel_path]
+                if item is None:
+                    print(rel_path)
+                else:
+                    print(u"{title} ({year})".format(title=item['title'],
+                                                     year=item['year']))
+        for rel_path in plan.conflicts:
+            print(u"Not creating a symlink for {path}, a file or folder is "
+                  u"in the way".format(path=rel_path))
+        if errors:
+            print(u"{count} changes to the library folder failed:".format(
+                count=len(errors)))
+            for rel_path, e in errors:
+                print(u"{path}: {e}".format(path=rel_path, e=e))
+        if reconciler.dangling:
+            print(u"Found {count} broken symlinks in the library "
+                  u"folder.".format(count=len(reconciler.dangling)))
 
         # Check if the new library exists in Plex
+        self.phases.start('library_scan')
         print(u"Creating the '{}' library in Plex...".format(
             self.recipe['new_library']['name']))
-        try:
-            new_library = self.plex.server.library.section(
-                self.recipe['new_library']['name'])
-            print(u"Library already exists in Plex. Scanning the library...")
-
-            new_library.update()
-        except plexapi.exceptions.NotFound:
-            self.plex.create_new_library(
-                self.recipe['new_library']['name'],
-                self.recipe['new_library']['folder'],
-                self.library_type)
-            new_library = self.plex.server.library.section(
-                self.recipe['new_library']['name'])
+        with self._scan_waiter() as waiter:
+            scans = 1
+            if new_library is not None:
+                print(u"Library already exists in Plex. Scanning the "
+                      u"library...")
+                scan_paths = self._scan_paths(reconciler, created + removed)
+                if scan_paths is None:
+                    new_library.update()
+                else:
+                    scans = len(scan_paths)
+                    for rel_path in scan_paths:
+                        new_library.update(path=os.path.join(
+                            self.recipe['new_library']['folder'], rel_path))
+                    print(u"Scanning {count} changed folders.".format(
+                        count=scans))
+            else:
+                self.plex.create_new_library(
+                    self.recipe['new_library']['name'],
+                    self.recipe['new_library']['folder'],
+                    self.library_type)
+                new_library = self.plex.server.library.section(
+                    self.recipe['new_library']['name'])
 
-        # Wait for metadata to finish downloading before continuing
-        print(u"Waiting for metadata to finish downloading...")
-        new_library = self.plex.server.library.section(
-            self.recipe['new_library']['name'])
-        while new_library.refreshing:
-            time.sleep(5)
-            new_library = self.plex.server.library.section(
-                self.recipe['new_library']['name'])
+            # Wait for metadata to finish downloading before continuing
+            if scans:
+                print(u"Waiting for metadata to finish downloading...")
+                waiter.wait(new_library, scans)
+        if removed:
+            # Clean up the items of the removed symlinks
+            new_library.emptyTrash()
 
         # Retrieve a list of items from the new library
+        self.phases.start('new_library_items')
         print(u"Retrieving a list of items from the '{library}' library in "
               u"Plex...".format(library=self.recipe['new_library']['name']))
-        all_new_items = new_library.all()
-
-        # Create a dictionary of {imdb_id: item}
-        imdb_map = {}
-        for m in all_new_items:
-            imdb_id = None
-            tmdb_id = None
-            tvdb_id = None
-            if m.guid is not None and 'imdb://' in m.guid:
-                imdb_id = m.guid.split('imdb://')[1].split('?')[0]
-            elif m.guid is not None and 'themoviedb://' in m.guid:
-                tmdb_id = m.guid.split('themoviedb://')[1].split('?')[0]
-            elif m.guid is not None and 'thetvdb://' in m.guid:
-                tvdb_id = (m.guid.split('thetvdb://')[1]
-                           .split('?')[0]
-                           .split('/')[0])
-            else:
-                imdb_id = None
-
-            if imdb_id and str(imdb_id) in item_ids:
-                imdb_map[imdb_id] = m
-            elif tmdb_id and ('tmdb' + str(tmdb_id)) in item_ids:
-                imdb_map['tmdb' + str(tmdb_id)] = m
-            elif tvdb_id and ('tvdb' + str(tvdb_id)) in item_ids:
-                imdb_map['tvdb' + str(tvdb_id)] = m
-            elif force_imdb_id_match:
-                # Only IMDB ID found for some items
-                if tmdb_id:
-                    imdb_id = self.tmdb.get_imdb_id(tmdb_id)
-                elif tvdb_id:
-                    imdb_id = self.tvdb.get_imdb_id(tvdb_id)
-                if imdb_id and str(imdb_id) in item_ids:
-                    imdb_map[imdb_id] = m
-                else:
-                    imdb_map[m.ratingKey] = m
-            else:
-                imdb_map[m.ratingKey] = m
+        new_snapshot = self._snapshot(new_library)
+        imdb_map = self._imdb_map(new_snapshot.values(), item_list,
+                                  force_imdb_id_match)
 
         # Modify the sort titles
+        self.phases.start('sort_titles')
+        writer = self._sort_title_writer(new_library, new_snapshot.values())
         if self.recipe['new_library']['sort']:
             print(u"Setting the sort titles for the '{}' library...".format(
                 self.recipe['new_library']['name']))
-        if self.recipe['new_library']['sort_title']['absolute']:
-            for i, m in enumerate(item_list):
-                item = imdb_map.pop(m['id'], None)
-                if not item:
-                    item = imdb_map.pop('tmdb' + str(m.get('tmdb_id', '')),
-                                        None)
-                if not item:
-                    item = imdb_map.pop('tvdb' + str(m.get('tvdb_id', '')),
-                                        None)
-                if item and self.recipe['new_library']['sort']:
-                    self.plex.set_sort_title(
-                        new_library.key, item.ratingKey, i+1, m['title'],
-                        self.library_type,
-                        self.recipe['new_library']['sort_title']['format'],
-                        self.recipe['new_library']['sort_title']['visible']
-                    )
-        else:
-            i = 0
-            for m in item_list:
-                item = imdb_map.pop(m['id'], None)
-                if not item:
-                    item = imdb_map.pop('tmdb' + str(m.get('tmdb_id', '')),
-                                        None)
-                if not item:
-                    item = imdb_map.pop('tvdb' + str(m.get('tvdb_id', '')),
-                                        None)
-                if item and self.recipe['new_library']['sort']:
-                    i += 1
-                    self.plex.set_sort_title(
-                        new_library.key, item.ratingKey, i, m['title'],
-                        self.library_type,
-                        self.recipe['new_library']['sort_title']['format'],
-                        self.recipe['new_library']['sort_title']['visible']
-                    )
-
-        if self.recipe['new_library']['remove_from_library'] \
-                or self.recipe['new_library'].get('remove_old', False):
-            # Remove items from the new library which no longer qualify
-            print(u"Removing symlinks for items "
-                  "which no longer qualify ".format(
-                    library=self.recipe['new_library']['name']))
-            count = 0
-            updated_paths = []
-            deleted_items = []
-            max_date = add_years((self.recipe['new_library']['max_age'] or 0) \
-                                 * -1)
-            if self.library_type == 'movie':
-                for movie in imdb_map.values():
-                    if not self.recipe['new_library']['remove_from_library']:
-                        # Only remove older than max_age
-                        if not self.recipe['new_library']['max_age'] \
-                                or (max_date < movie.originallyAvailableAt):
-                            continue
-
-                    for part in movie.iterParts():
-                        old_path_file = part.file
-                        old_path, file_name = os.path.split(old_path_file)
-
-                        folder_name = os.path.relpath(
-                            old_path, self.recipe['new_library']['folder'])
-
-                        if folder_name == '.':
-                            new_path = os.path.join(
-                                self.recipe['new_library']['folder'],
-                                file_name)
-                            dir = False
-                        else:
-                            new_path = os.path.join(
-                                self.recipe['new_library']['folder'],
-                                folder_name)
-                            dir = True
-
-                        if (dir and os.path.exists(new_path)) or \
-                                (not dir and os.path.isfile(new_path)):
-                            try:
-                                if os.name == 'nt':
-                                    # Python 3.2+ only
-                                    if sys.version_info < (3, 2):
-                                        assert os.path.islink(new_path)
-                                    if dir:
-                                        os.rmdir(new_path)
-                                    else:
-                                        os.remove(new_path)
-                                else:
-                                    assert os.path.islink(new_path)
-                                    os.unlink(new_path)
-                                count += 1
-                                deleted_items.append(movie)
-                                updated_paths.append(new_path)
-                            except Exception as e:
-                                print(u"Remove symlink failed for "
-                                      "{path}: {e}".format(path=new_path,
-                                                           e=e))
-            else:
-                for tv_show in imdb_map.values():
-                    done = False
-                    if done:
-                        continue
-                    for episode in tv_show.episodes():
-                        if done:
-                            break
-                        for part in episode.iterParts():
-                            if done:
-                                break
-                            old_path_file = part.file
-                            old_path, file_name = os.path.split(old_path_file)
-
-                            folder_name = ''
-                            new_library_folder = \
-                                self.recipe['new_library']['folder']
-                            old_path = os.path.join(
-                                new_library_folder,
-                                old_path.replace(new_library_folder, '').strip(
-                                    os.sep).split(os.sep)[0])
-                            folder_name = os.path.relpath(old_path,
-                                                          new_library_folder)
-
-                            new_path = os.path.join(
-                                self.recipe['new_library']['folder'],
-                                folder_name)
-                            if os.path.exists(new_path):
-                                try:
-                                    if os.name == 'nt':
-                                        # Python 3.2+ only
-                                        if sys.version_info < (3, 2):
-                                            assert os.path.islink(new_path)
-                                        os.rmdir(new_path)
-                                    else:
-                                        assert os.path.islink(new_path)
-                                        os.unlink(new_path)
-                                    count += 1
-                                    deleted_items.append(tv_show)
-                                    updated_paths.append(new_path)
-                                    done = True
-                                    break
-                                except Exception as e:
-                                    print(u"Remove symlink failed for "
-                                          "{path}: {e}".format(path=new_path,
-                                                               e=e))
-                            else:
-                                done = True
-                                break
-
-            print(u"Removed symlinks for {count} items.".format(count=count))
-            for item in deleted_items:
-                print(u"{title} ({year})".format(title=item.title,
-                                                 year=item.year))
-
-            # Scan the library to clean up the deleted items
-            print(u"Scanning the '{library}' library...".format(
-                library=self.recipe['new_library']['name']))
-            new_library.update()
-            time.sleep(10)
-            new_library = self.plex.server.library.section(
-                self.recipe['new_library']['name'])
-            while new_library.refreshing:
-                time.sleep(5)
-                new_library = self.plex.server.library.section(
-                    self.recipe['new_library']['name'])
-            new_library.emptyTrash()
-            all_new_items = new_library.all()
-        else:
-            while imdb_map:
-                imdb_id, item = imdb_map.popitem()
-                i += 1
-                self.plex.set_sort_title(
-                    new_library.key, item.ratingKey, i, item.title,
-                    self.library_type,
-                    self.recipe['new_library']['sort_title']['format'],
-                    self.recipe['new_library']['sort_title']['visible'])
-
-        return missing_items, len(all_new_items)
-
-    def _run_sort_only(self):
-        item_list = []
-        item_ids = []
-        force_imdb_id_match = False
-
-        # Get the trakt lists
-        for url in self.recipe['source_list_urls']:
-            if 'api.trakt.tv' in url:
-                (item_list, item_ids) = self.trakt.add_items(
-                    self.library_type, url, item_list, item_ids,
-                    self.recipe['new_library']['max_age'] or 0)
-            else:
-                raise Exception("Unsupported source list: {url}".format(
-                    url=url))
+        for rating_key, number, title in self._sort_titles(
+                item_list, imdb_map, self.recipe['new_library']['sort'],
+                not remove):
+            writer.set(rating_key, number, title)
+        self._write_sort_titles(writer)
+
+        # Our own edits count as unchanged for the next run
+        self.phases.start('run_state')
+        new_snapshot.refresh()
+        if source_snapshots:
+            self._save_run_state(self._run_state(source_snapshots,
+                                                 new_snapshot))
+
+        return run_plan.missing_items, len(new_snapshot.items)
+
+    def _run_sort_only(self, scan=False):
+        force_imdb_id_match = self.recipe['new_library'].get(
+            'force_imdb_id_match', False)
+
+        self.phases.start('source_lists')
+        pipeline = self._pipeline()
+        try:
+            item_list = self._get_source_lists(pipeline)
+        finally:
+            pipeline.close()
 
+        self.phases.start('weighted_sorting')
         if self.recipe['weighted_sorting']['enabled']:
             if self.config['tmdb']['api_key']:
                 print(u"Getting data from TMDb to add weighted sorting...")
-                item_list = self.weighted_sorting(item_list)
+                item_list = self.weighted_sorting(item_list,
+                                                  pipeline.details)
             else:
                 print(u"Warning: TMDd API key is required "
                       "for weighted sorting")
 
-        try:
-            new_library = self.plex.server.library.section(
-                self.recipe['new_library']['name'])
-        except:
+        new_library = self.clients.section(self.recipe['new_library']['name'])
+        if new_library is None:
             raise Exception("Library '{library}' does not exist".format(
                 library=self.recipe['new_library']['name']))
 
-        new_library.update()
-        # Wait for metadata to finish downloading before continuing
-        print(u"Waiting for metadata to finish downloading...")
-        new_library = self.plex.server.library.section(
-            self.recipe['new_library']['name'])
-        while new_library.refreshing:
-            time.sleep(5)
-            new_library = self.plex.server.library.section(
-                self.recipe['new_library']['name'])
+        if scan:
+            self.phases.start('library_scan')
+            with self._scan_waiter() as waiter:
+                new_library.update()
+                # Wait for metadata to finish downloading before continuing
+                print(u"Waiting for metadata to finish downloading...")
+                waiter.wait(new_library)
 
-        # Retrieve a list of items from the new library
+        # The items with their current titles, in a single listing
+        self.phases.start('new_library_items')
         print(u"Retrieving a list of items from the '{library}' library in "
               u"Plex...".format(library=self.recipe['new_library']['name']))
-        all_new_items = new_library.all()
-
-        # Create a dictionary of {imdb_id: item}
-        imdb_map = {}
-        for m in all_new_items:
-            imdb_id = None
-            tmdb_id = None
-            tvdb_id = None
-            if m.guid is not None and 'imdb://' in m.guid:
-                imdb_id = m.guid.split('imdb://')[1].split('?')[0]
-            elif m.guid is not None and 'themoviedb://' in m.guid:
-                tmdb_id = m.guid.split('themoviedb://')[1].split('?')[0]
-            elif m.guid is not None and 'thetvdb://' in m.guid:
-                tvdb_id = (m.guid.split('thetvdb://')[1]
-                           .split('?')[0]
-                           .split('/')[0])
-            else:
-                imdb_id = None
-
-            if imdb_id and str(imdb_id) in item_ids:
-                imdb_map[imdb_id] = m
-            elif tmdb_id and ('tmdb' + str(tmdb_id)) in item_ids:
-                imdb_map['tmdb' + str(tmdb_id)] = m
-            elif tvdb_id and ('tvdb' + str(tvdb_id)) in item_ids:
-                imdb_map['tvdb' + str(tvdb_id)] = m
-            elif force_imdb_id_match:
-                # Only IMDB ID found for some items
-                if tmdb_id:
-                    imdb_id = self.tmdb.get_imdb_id(tmdb_id)
-                elif tvdb_id:
-                    imdb_id = self.tvdb.get_imdb_id(tvdb_id)
-                if imdb_id and str(imdb_id) in item_ids:
-                    imdb_map[imdb_id] = m
-                else:
-                    imdb_map[m.ratingKey] = m
-            else:
-                imdb_map[m.ratingKey] = m
+        records = self.plex.section_records(new_library.key)
+        imdb_map = self._imdb_map(records, item_list, force_imdb_id_match)
 
-        # Modify the sort titles
+        # Modify the sort titles that changed
+        self.phases.start('sort_titles')
+        writer = self._sort_title_writer(new_library, records)
         print(u"Setting the sort titles for the '{}' library...".format(
             self.recipe['new_library']['name']))
-        if self.recipe['new_library']['sort_title']['absolute']:
-            for i, m in enumerate(item_list):
-                item = imdb_map.pop(m['id'], None)
-                if not item:
-                    item = imdb_map.pop('tmdb' + str(m.get('tmdb_id', '')),
-                                        None)
-                if not item:
-                    item = imdb_map.pop('tvdb' + str(m.get('tvdb_id', '')),
-                                        None)
-                if item:
-                    self.plex.set_sort_title(
-                        new_library.key, item.ratingKey, i+1, m['title'],
-                        self.library_type,
-                        self.recipe['new_library']['sort_title']['format'],
-                        self.recipe['new_library']['sort_title']['visible'])
-        else:
-            i = 0
-            for m in item_list:
-                item = imdb_map.pop(m['id'], None)
-                if not item:
-                    item = imdb_map.pop('tmdb' + str(m.get('tmdb_id', '')),
-                                        None)
-                if not item:
-                    item = imdb_map.pop('tvdb' + str(m.get('tvdb_id', '')),
-                                        None)
-                if item:
-                    i += 1
-                    self.plex.set_sort_title(
-                        new_library.key, item.ratingKey, i, m['title'],
-                        self.library_type,
-                        self.recipe['new_library']['sort_title']['format'],
-                        self.recipe['new_library']['sort_title']['visible'])
-            while imdb_map:
-                imdb_id, item = imdb_map.popitem()
-                i += 1
-                self.plex.set_sort_title(
-                    new_library.key, item.ratingKey, i, item.title,
-                    self.library_type,
-                    self.recipe['new_library']['sort_title']['format'],
-                    self.recipe['new_library']['sort_title']['visible'])
-
-        return len(all_new_items)
-
-    def run(self, sort_only=False):
+        for rating_key, number, title in self._sort_titles(
+                item_list, imdb_map, leftovers=not self.recipe[
+                    'new_library']['sort_title']['absolute']):
+            writer.set(rating_key, number, title)
+        self._write_sort_titles(writer)
+
+        return len(records)
+
+    def run(self, sort_only=False, scan=False):
+        """Run the recipe
+
+        With sort_only, only the sort titles of the items already in the
+        new library are set, without scanning it first unless scan is
+        True.
+        """
+        self._measured(self._run_and_report, sort_only, scan)
+
+    def plan(self, path):
+        """Save the changes a run would make to path, making none"""
+        self._measured(self._plan_and_save, path)
+
+    def apply(self, run_plan):
+        """Make the changes of a RunPlan saved by plan()"""
+        self._measured(self._apply_and_report, run_plan)
+
+    def _measured(self, func, *args):
+        """Call func, keeping the metrics of the run"""
+        started = time.time()
+        before = self.clients.metrics.snapshot()
+        self.phases = metrics.PhaseTimer()
+        success = False
+        try:
+            func(*args)
+            success = True
+        finally:
+            self.phases.stop()
+            finished = time.time()
+            self.run_metrics = self.clients.metrics.since(before)
+            self.run_metrics.update(self.phases.metrics)
+            self.run_metrics.add_many([
+                ('run_duration_seconds', finished - started, {}),
+                ('run_success', 1 if success else 0, {}),
+                ('run_timestamp_seconds', finished, {}),
+            ])
+            self._write_metrics(started, finished, success)
+
+    def _run_and_report(self, sort_only=False, scan=False):
         if sort_only:
             print(u"Running the recipe '{}', sorting only".format(
                 self.recipe_name))
-            list_count = self._run_sort_only()
+            list_count = self._run_sort_only(scan)
             print(u"Number of items in the new library: {count}".format(
                 count=list_count))
         else:
             print(u"Running the recipe '{}'".format(self.recipe_name))
-            missing_items, list_count = self._run()
-            print(u"Number of items in the new library: {count}".format(
-                count=list_count))
-            print(u"Number of missing items: {count}".format(
-                count=len(missing_items)))
-            for idx, item in missing_items:
-                print(u"{idx}\t{release}\t{imdb_id}\t{title} ({year})".format(
-                    idx=idx+1, release=item.get('release_date', ''),
-                    imdb_id=item['id'], title=item['title'],
-                    year=item['year']))
-
-    def weighted_sorting(self, item_list):
+            result = self._run()
+            if result is not None:
+                self._report(result)
+
+    def _report(self, result):
+        missing_items, list_count = result
+        print(u"Number of items in the new library: {count}".format(
+            count=list_count))
+        print(u"Number of missing items: {count}".format(
+            count=len(missing_items)))
+        for idx, item in missing_items:
+            print(u"{idx}\t{release}\t{imdb_id}\t{title} ({year})".format(
+                idx=idx+1, release=item.release_date or '',
+                imdb_id=item.id, title=item.title, year=item.year))
+
+    def _plan_and_save(self, path):
+        print(u"Planning the recipe '{}'".format(self.recipe_name))
+        run_plan = self._plan(preview=True)
+        run_plan.save(path)
+        links = run_plan.links
+        print(u"Matched {matched} items, {missing} are missing".format(
+            matched=run_plan.matched, missing=len(run_plan.missing_items)))
+        print(u"Symlinks: {add} to add, {retarget} to change, {remove} to "
+              u"remove, {conflicts} in the way".format(
+                add=len(links.links), retarget=len(links.retargets),
+                remove=len(links.removals), conflicts=len(links.conflicts)))
+        print(u"Sort titles for the {count} items already in the "
+              u"library".format(count=len(run_plan.sort_titles)))
+        print(u"Saved the plan to {path}".format(path=path))
+
+    def _apply_and_report(self, run_plan):
+        if run_plan.recipe_name != self.recipe_name:
+            raise Exception("The plan is for the recipe '{}'".format(
+                run_plan.recipe_name))
+        print(u"Applying the plan of the recipe '{name}' from "
+              u"{created}".format(
+                name=self.recipe_name,
+                created=time.strftime('%Y-%m-%d %H:%M:%S',
+                                      time.localtime(run_plan.created))))
+        result = self._apply_plan(run_plan)
+        if result is not None:
+            self._report(result)
+
+    def _write_metrics(self, started, finished, success):
+        """Write the timings and counters of the run, if configured"""
+        directory = (self.config.get('metrics') or {}).get('directory')
+        if not directory:
+            return
+        try:
+            metrics.write_run(directory, self.recipe_name, self.run_metrics,
+                              started, finished, success)
+        except (IOError, OSError) as e:
+            print(u"Unable to write the metrics of the run: {e}".format(e=e))
+
+    def _add_tmdb_details(self, m, details, today):
         def _get_non_theatrical_release(release_dates):
             # Returns earliest release date that is not theatrical
             # TODO PREDB
@@ -718,126 +858,92 @@ class Recipe(object):
 
             return release_date
 
-        def _get_age_weight(days):
-            if self.library_type == 'movie':
-                # Everything younger than this will get 1
-                min_days = 180
-                # Everything older than this will get 0
-                max_days = (float(self.recipe['new_library']['max_age'])
-                            / 4.0 * 365.25 or 360)
-            else:
-                min_days = 14
-                max_days = (float(self.recipe['new_library']['max_age'])
-                            / 4.0 * 365.25 or 180)
-            if days <= min_days:
-                return 1
-            elif days >= max_days:
-                return 0
+        m.tmdb_popularity = float(details['popularity'])
+        m.tmdb_vote = float(details['vote_average'])
+        m.tmdb_vote_count = int(details['vote_count'])
+        if self.library_type == 'movie':
+            if self.recipe['weighted_sorting']['better_release_date']:
+                m.release_date = _get_non_theatrical_release(
+                    details['release_dates']) or \
+                    datetime.datetime.strptime(details['release_date'],
+                                               '%Y-%m-%d').date()
             else:
-                return 1 - (days - min_days) / (max_days - min_days)
-
-        total_items = len(item_list)
-
+                m.release_date = datetime.datetime.strptime(
+                    details['release_date'], '%Y-%m-%d').date()
+            item_age_td = today - m.release_date
+        elif self.library_type == 'tv':
+            m.last_air_date = datetime.datetime.strptime(
+                details['last_air_date'], '%Y-%m-%d').date()
+            item_age_td = today - m.last_air_date
+        m.genres = [g['name'].lower() for g in details['genres']]
+        m.age = item_age_td.days
+
+    def weighted_sorting(self, item_list, details=None):
+        """Sort the items by their weights
+
+        details is a {tmdb_id: details} dict of the TMDb details already
+        fetched (see ItemPipeline), the others are fetched here.
+        """
         weights = self.recipe['weighted_sorting']['weights']
 
         # TMDB details
         today = datetime.date.today()
-        total_tmdb_vote = 0.0
-        tmdb_votes = []
-        for i, m in enumerate(item_list):
-            m['original_idx'] = i + 1
-            details = self.tmdb.get_details(m['tmdb_id'], self.library_type)
-            if not details:
-                print(u"Warning: No TMDb data for {}".format(m['title']))
-                continue
-            m['tmdb_popularity'] = float(details['popularity'])
-            m['tmdb_vote'] = float(details['vote_average'])
-            m['tmdb_vote_count'] = int(details['vote_count'])
-            if self.library_type == 'movie':
-                if self.recipe['weighted_sorting']['better_release_date']:
-                    m['release_date'] = _get_non_theatrical_release(
-                        details['release_dates']) or \
-                        datetime.datetime.strptime(details['release_date'],
-                                                   '%Y-%m-%d').date()
-                else:
-                    m['release_date'] = datetime.datetime.strptime(
-                        details['release_date'], '%Y-%m-%d').date()
-                item_age_td = today - m['release_date']
-            elif self.library_type == 'tv':
-                m['last_air_date'] = datetime.datetime.strptime(
-                    details['last_air_date'], '%Y-%m-%d').date()
-                item_age_td = today - m['last_air_date']
-            m['genres'] = [g['name'].lower() for g in details['genres']]
-            m['age'] = item_age_td.days
-            if (self.library_type == 'tv' or m['tmdb_vote_count'] > 150 or
-                    m['age'] > 50):
-                tmdb_votes.append(m['tmdb_vote'])
-            total_tmdb_vote += m['tmdb_vote']
-            item_list[i] = m
-
-        tmdb_votes.sort()
-
+        items_by_tmdb_id = {}
         for i, m in enumerate(item_list):
-            # Distribute all weights evenly from 0 to 1 (times global factor)
-            # More weight means it'll go higher in the final list
-            index_weight = float(total_items - i) / float(total_items)
-            m['index_weight'] = index_weight * weights['index']
-            if m.get('tmdb_popularity'):
-                if (self.library_type == 'tv' or
-                        m.get('tmdb_vote_count') > 150 or m['age'] > 50):
-                    vote_weight = ((tmdb_votes.index(m['tmdb_vote']) + 1)
-                                   / float(len(tmdb_votes)))
-                else:
-                    # Assume below average rating for new/less voted items
-                    vote_weight = 0.25
-                age_weight = _get_age_weight(float(m['age']))
-
-                if weights.get('random'):
-                    random_weight = random.random()
-                    m['random_weight'] = random_weight * weights['random']
-                else:
-                    m['random_weight'] = 0.0
-
-                m['vote_weight'] = vote_weight * weights['vote']
-                m['age_weight'] = age_weight * weights['age']
-
-                weight = (m['index_weight'] + m['vote_weight']
-                          + m['age_weight'] + m['random_weight'])
-                for genre, value in weights['genre_bias'].items():
-                    if genre.lower() in m['genres']:
-                        weight *= value
-
-                m['weight'] = weight
-            else:
-                m['vote_weight'] = 0.0
-                m['age_weight'] = 0.0
-                m['weight'] = index_weight
-            item_list[i] = m
+            m.original_idx = i + 1
+            items_by_tmdb_id.setdefault(m.tmdb_id, []).append(m)
+
+        # Fetch the rest concurrently and fill in the items as the details
+        # arrive
+        details = details or {}
+        fetched = self.tmdb.iter_details(
+            [tmdb_id for tmdb_id in items_by_tmdb_id
+             if tmdb_id not in details], self.library_type)
+        for tmdb_id, item_details in itertools.chain(details.items(),
+                                                     fetched):
+            for m in items_by_tmdb_id.get(tmdb_id, ()):
+                if not item_details:
+                    print(u"Warning: No TMDb data for {}".format(m.title))
+                    continue
+                self._add_tmdb_details(m, item_details, today)
 
-        item_list.sort(key=lambda m: m['weight'], reverse=True)
+        weighting.score(item_list, weights, self.library_type,
+                        self.recipe['new_library']['max_age'])
+        item_list.sort(key=lambda m: m.weight, reverse=True)
 
         for i, m in enumerate(item_list):
-            if (i+1) < m['original_idx']:
+            if (i+1) < m.original_idx:
                 net = Colors.GREEN + u'↑'
-            elif (i+1) > m['original_idx']:
+            elif (i+1) > m.original_idx:
                 net = Colors.RED + u'↓'
             else:
                 net = u' '
-            net += str(abs(i + 1 - m['original_idx'])).rjust(3)
+            net += str(abs(i + 1 - m.original_idx)).rjust(3)
             try:
                 # TODO
                 print(u"{} {:>3}: trnd:{:>3}, w_trnd:{:0<5}; vote:{}, "
                       "w_vote:{:0<5}; age:{:>4}, w_age:{:0<5}; w_rnd:{:0<5}; "
                       "w_cmb:{:0<5}; {} {}{}"
-                      .format(net, i+1, m['original_idx'],
-                              round(m['index_weight'], 3),
-                              m.get('tmdb_vote', 0.0),
-                              round(m['vote_weight'], 3), m.get('age', 0),
-                              round(m['age_weight'], 3),
-                              round(m.get('random_weight', 0), 3),
-                              round(m['weight'], 3), str(m['title']),
-                              str(m['year']), Colors.RESET))
+                      .format(net, i+1, m.original_idx,
+                              round(m.index_weight, 3),
+                              m.tmdb_vote or 0.0,
+                              round(m.vote_weight, 3), m.age,
+                              round(m.age_weight, 3),
+                              round(m.random_weight, 3),
+                              round(m.weight, 3), str(m.title),
+                              str(m.year), Colors.RESET))
             except UnicodeEncodeError:
                 pass
 
         return item_list
+
+
+def run_recipe(name, clients, sort_only=False, scan=False):
+    """Run a recipe, returning False if it failed"""
+    try:
+        Recipe(name, clients=clients).run(sort_only, scan)
+    except Exception:
+        print(u"Error: The recipe '{}' failed".format(name))
+        traceback.print_exc()
+        return False
+    return True
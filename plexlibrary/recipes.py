@@ -5,18 +5,24 @@ import os
 from utils import YAMLBase
 
 
+def recipe_directory(directory=None):
+    if not directory:
+        parent_dir = os.path.abspath(
+            os.path.join(os.path.dirname(__file__), os.path.pardir))
+        directory = os.path.join(parent_dir, 'recipes')
+    return directory
+
+
+def recipe_path(name, directory=None):
+    # TODO support .yaml
+    return os.path.join(recipe_directory(directory), name + '.yml')
+
+
 class RecipeParser(YAMLBase):
     def __init__(self, name, directory=None):
         # TODO accept filename
         self.name = os.path.splitext(name)[0]
-        recipe_file = self.name + '.yml'  # TODO support .yaml
-        # FIXME?
-        if not directory:
-            parent_dir = os.path.abspath(
-                os.path.join(os.path.dirname(__file__), os.path.pardir))
-            directory = os.path.join(parent_dir, 'recipes')
-
-        filepath = os.path.join(directory, recipe_file)
+        filepath = recipe_path(self.name, directory)
 
         super(RecipeParser, self).__init__(filepath)
 
@@ -25,10 +31,7 @@ class RecipeParser(YAMLBase):
 
 
 def get_recipes(directory=None):
-    if not directory:
-        parent_dir = os.path.abspath(
-            os.path.join(os.path.dirname(__file__), os.path.pardir))
-        directory = os.path.join(parent_dir, 'recipes')
+    directory = recipe_directory(directory)
 
     recipes = []
     for path in glob.glob(os.path.join(directory, '*.yml')):
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""runplan
+
+The changes a recipe run makes, worked out before making them
+"""
+
+import datetime
+import json
+import time
+
+import symlinks
+from mediaitem import ItemCollection, MediaItem
+from utils import write_atomic
+
+
+def _item_dict(m):
+    return {
+        'imdb': m.id,
+        'tmdb': m.tmdb_id,
+        'tvdb': m.tvdb_id,
+        'title': m.title,
+        'year': m.year,
+        'release_date': m.release_date.isoformat() if m.release_date
+        else None,
+    }
+
+
+def _media_item(data):
+    m = MediaItem(data['imdb'], tmdb_id=data['tmdb'], tvdb_id=data['tvdb'],
+                  title=data['title'], year=data['year'])
+    if data.get('release_date'):
+        m.release_date = datetime.datetime.strptime(
+            data['release_date'], '%Y-%m-%d').date()
+    return m
+
+
+def _record_dict(record):
+    """The parts of a Plex item record needed to carry out a plan"""
+    if record is None:
+        return None
+    return dict((k, record.get(k)) for k in (
+        'ratingKey', 'title', 'year', 'addedAt', 'updatedAt'))
+
+
+class RunPlan(object):
+    """Matched items, symlink changes and sort titles of a run
+
+    Saved as JSON by `plexlibrary --plan` and carried out later by
+    `plexlibrary --apply`. The sort titles of the items that aren't in
+    the new library yet are only known once Plex has scanned them, so
+    the plan keeps the final list order and sort_titles only previews
+    the items already there.
+    """
+    version = 1
+
+    def __init__(self, recipe_name, library_type, item_list, missing_items,
+                 reconciler, links, removals):
+        self.recipe_name = recipe_name
+        self.library_type = library_type
+        # Final order of the list items, and the (index, item) of the
+        # ones not found in the source libraries
+        self.item_list = item_list
+        self.missing_items = missing_items
+        # The wanted links are in reconciler.desired
+        self.reconciler = reconciler
+        self.links = links
+        # {relative path: record or None} of the links to remove
+        self.removals = removals
+        # Number of list items found in the source libraries
+        self.matched = 0
+        # (ratingKey, title, titleSort) of the new library items
+        self.sort_titles = []
+        self.created = time.time()
+
+    def to_dict(self):
+        links = self.links
+        return {
+            'version': self.version,
+            'recipe': self.recipe_name,
+            'library_type': self.library_type,
+            'created': self.created,
+            'folder': self.reconciler.folder,
+            'items': [_item_dict(m) for m in self.item_list],
+            'matched': self.matched,
+            'missing': [[i, _item_dict(m)] for i, m in self.missing_items],
+            'desired': dict(
+                (rel_path, [target, is_dir, _record_dict(item)])
+                for rel_path, (target, is_dir, item)
+                in self.reconciler.desired.items()),
+            'dangling': sorted(self.reconciler.dangling),
+            'links': {
+                'mkdirs': links.mkdirs,
+                'rmdirs': links.rmdirs,
+                'links': links.links,
+                'retargets': links.retargets,
+                'removals': links.removals,
+                'conflicts': links.conflicts,
+            },
+            'removals': dict((rel_path, _record_dict(record))
+                             for rel_path, record in self.removals.items()),
+            'sort_titles': [
+                {'ratingKey': rating_key, 'title': title,
+                 'titleSort': title_sort}
+                for rating_key, title, title_sort in self.sort_titles],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get('version') != cls.version:
+            raise Exception("Unsupported plan version: {}".format(
+                data.get('version')))
+        reconciler = symlinks.Reconciler(data['folder'])
+        for rel_path, (target, is_dir, item) in data['desired'].items():
+            reconciler.add(rel_path, target, is_dir, item)
+        reconciler.dangling = set(data['dangling'])
+        links = symlinks.Plan()
+        links.mkdirs = data['links']['mkdirs']
+        links.rmdirs = data['links']['rmdirs']
+        links.links = [tuple(link) for link in data['links']['links']]
+        links.retargets = [tuple(link)
+                           for link in data['links']['retargets']]
+        links.removals = data['links']['removals']
+        links.conflicts = data['links']['conflicts']
+        run_plan = cls(
+            data['recipe'], data['library_type'],
+            ItemCollection(_media_item(m) for m in data['items']),
+            [(i, _media_item(m)) for i, m in data['missing']],
+            reconciler, links, data['removals'])
+        run_plan.sort_titles = [
+            (s['ratingKey'], s['title'], s['titleSort'])
+            for s in data['sort_titles']]
+        run_plan.matched = data['matched']
+        run_plan.created = data['created']
+        return run_plan
+
+    def save(self, path):
+        write_atomic(path, json.dumps(self.to_dict(), indent=2,
+                                      sort_keys=True))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls.from_dict(json.load(f))
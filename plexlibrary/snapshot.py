@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""snapshot
+
+On-disk snapshots of Plex library sections, refreshed incrementally
+"""
+
+import glob
+import json
+import os
+import tempfile
+
+from plexutils import GuidIndex
+from utils import write_atomic
+
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(),
+                                 'plexlibrary_snapshots')
+
+
+class LibrarySnapshot(object):
+    """The items of a library section, keyed by ratingKey
+
+    Each run only fetches the items added or updated since the newest
+    item in the snapshot, including the ones of that same second, which
+    may have changed after it was taken. Removed items are detected by
+    comparing the item count with the server, which triggers a full
+    listing.
+    """
+
+    def __init__(self, plex, section, directory=None):
+        self.plex = plex
+        self.section = section
+        self.directory = directory or DEFAULT_DIRECTORY
+        self.path = os.path.join(self.directory,
+                                 '{}.json'.format(section.uuid))
+        self.items = {}
+        self._index = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                self.items = json.load(f)['items']
+        except (IOError, OSError, ValueError, KeyError):
+            # Missing or corrupt snapshot, start over
+            self.items = {}
+        self._index = None
+
+    def save(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        write_atomic(self.path, json.dumps({
+            'section': self.section.key,
+            'title': self.section.title,
+            'type': self.section.type,
+            'items': self.items,
+        }))
+
+    @property
+    def watermark(self):
+        """Newest addedAt/updatedAt timestamp in the snapshot"""
+        return max([max(r['addedAt'], r['updatedAt'])
+                    for r in self.items.values()] or [0])
+
+    def refresh(self):
+        """Bring the snapshot up to date with the server and save it
+
+        Returns the number of records fetched.
+        """
+        since = self.watermark
+        if since:
+            # The filters are strict, so ask from the second before
+            changed = self.plex.section_records(
+                self.section.key, **{'updatedAt>>': since - 1})
+            changed += self.plex.section_records(
+                self.section.key, **{'addedAt>>': since - 1})
+            # Update a copy, other threads may be reading the items
+            items = dict(self.items)
+            for record in changed:
+                items[record['ratingKey']] = record
+            if len(items) == self.plex.section_size(self.section.key):
+                if items != self.items:
+                    self.items = items
+                    self._index = None
+                    self.save()
+                return len(changed)
+            # Items were removed, rebuild from scratch
+        records = self.plex.section_records(self.section.key)
+        self.items = dict((r['ratingKey'], r) for r in records)
+        self._index = None
+        self.save()
+        return len(records)
+
+    def values(self):
+        return self.items.values()
+
+    def guid_index(self):
+        """Return a GuidIndex of the items, kept until they change"""
+        if self._index is None:
+            index = GuidIndex()
+            for record in self.items.values():
+                index.add(record, record['guids'])
+            self._index = index
+        return self._index
+
+
+class SnapshotSection(object):
+    """Stands in for a library section when working offline"""
+
+    def __init__(self, key, uuid, title, type):
+        self.key = key
+        self.uuid = uuid
+        self.title = title
+        self.type = type
+
+
+def find_section(title, directory=None):
+    """Return the section of the snapshot of a library, or None
+
+    Only snapshots saved since they record the library title are found.
+    """
+    directory = directory or DEFAULT_DIRECTORY
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        if data.get('title') == title:
+            uuid = os.path.splitext(os.path.basename(path))[0]
+            return SnapshotSection(data['section'], uuid, title,
+                                   data.get('type'))
+    return None
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""symlinks
+
+Keeps the symlinks in a new library folder in line with the recipe
+"""
+
+import collections
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+def coalesce(rel_paths, max_siblings=10):
+    """Reduce changed paths to the directories worth scanning
+
+    Directories with more than max_siblings changed entries are scanned
+    as a whole, and paths inside other paths are dropped. Returns None
+    when that ends up at the top of the folder.
+    """
+    paths = set(os.path.normpath(p) for p in rel_paths)
+    merged = True
+    while merged:
+        merged = False
+        by_parent = {}
+        for path in paths:
+            by_parent.setdefault(os.path.dirname(path), set()).add(path)
+        for parent, children in by_parent.items():
+            if len(children) > max_siblings:
+                paths -= children
+                paths.add(parent)
+                merged = True
+    if '' in paths:
+        return None
+    res = []
+    for path in sorted(paths):
+        parent = os.path.dirname(path)
+        while parent and parent not in paths:
+            parent = os.path.dirname(parent)
+        if not parent:
+            res.append(path)
+    return res
+
+
+class Plan(object):
+    """The changes needed to bring a library folder up to date"""
+
+    def __init__(self):
+        # Relative paths of directories to create or (empty ones) remove
+        self.mkdirs = []
+        self.rmdirs = []
+        # (relative path, target, is_dir) of the links to (re)create
+        self.links = []
+        self.retargets = []
+        # Relative paths of links to remove
+        self.removals = []
+        # Relative paths in the way of a link which aren't ours to remove
+        self.conflicts = []
+
+    def __len__(self):
+        return (len(self.mkdirs) + len(self.rmdirs) + len(self.links)
+                + len(self.retargets) + len(self.removals))
+
+
+class Reconciler(object):
+    """Compares the wanted symlinks with the ones in the folder
+
+    The folder is scanned once with os.scandir. Subdirectories that
+    aren't symlinks are descended into, since links can be nested.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        # {relative path: (target, is_dir, item)}
+        self.desired = {}
+        # {relative path: target} of the links found by scan()
+        self.existing = {}
+        self.dangling = set()
+        # {relative path: is empty} of the plain directories
+        self.dirs = {}
+        self.files = set()
+
+    def add(self, rel_path, target, is_dir, item=None):
+        """Ask for a link at rel_path (relative to the folder)"""
+        rel_path = os.path.normpath(rel_path)
+        if rel_path not in self.desired:
+            self.desired[rel_path] = (target, is_dir, item)
+
+    def scan(self):
+        self.existing = {}
+        self.dangling = set()
+        self.dirs = {}
+        self.files = set()
+        self._scan(self.folder, '')
+
+    def _scan(self, path, rel_dir):
+        empty = True
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            return True
+        for entry in entries:
+            empty = False
+            rel_path = os.path.join(rel_dir, entry.name)
+            if entry.is_symlink():
+                target = os.readlink(entry.path)
+                if not os.path.isabs(target):
+                    target = os.path.join(path, target)
+                self.existing[rel_path] = os.path.normpath(target)
+                try:
+                    # Follows the link, so this fails for dangling ones
+                    entry.stat()
+                except OSError:
+                    self.dangling.add(rel_path)
+            elif entry.is_dir(follow_symlinks=False):
+                self.dirs[rel_path] = self._scan(entry.path, rel_path)
+            else:
+                self.files.add(rel_path)
+        return empty
+
+    def link_for(self, path):
+        """Return the existing link that the path lies in, if any"""
+        rel_path = os.path.relpath(path, self.folder)
+        if rel_path.startswith(os.pardir):
+            return None
+        parts = rel_path.split(os.sep)
+        for i in range(1, len(parts) + 1):
+            prefix = os.path.join(*parts[:i])
+            if prefix in self.existing:
+                return prefix
+        return None
+
+    def plan(self, removals=()):
+        """Work out the changes to make
+
+        Links that aren't wanted are only removed if listed in removals.
+        """
+        plan = Plan()
+        new_dirs = set()
+        for rel_path, (target, is_dir, item) in sorted(self.desired.items()):
+            if rel_path in self.existing:
+                if self.existing[rel_path] != os.path.normpath(target):
+                    plan.retargets.append((rel_path, target, is_dir))
+                continue
+            if rel_path in self.files or (rel_path in self.dirs
+                                          and not self.dirs[rel_path]):
+                plan.conflicts.append(rel_path)
+                continue
+            if rel_path in self.dirs:
+                # Clean up old, empty directories
+                plan.rmdirs.append(rel_path)
+            parent = os.path.dirname(rel_path)
+            while parent and parent not in self.dirs \
+                    and parent not in new_dirs:
+                new_dirs.add(parent)
+                parent = os.path.dirname(parent)
+            plan.links.append((rel_path, target, is_dir))
+        # Parents before children
+        plan.mkdirs = sorted(new_dirs, key=lambda d: d.count(os.sep))
+        plan.removals = sorted(p for p in set(removals)
+                               if p in self.existing
+                               and p not in self.desired)
+        return plan
+
+    def _path(self, rel_path):
+        return os.path.join(self.folder, rel_path)
+
+    def _symlink(self, rel_path, target, is_dir):
+        path = self._path(rel_path)
+        if os.name == 'nt':
+            if is_dir:
+                subprocess.call(['mklink', '/D', path, target], shell=True)
+            else:
+                subprocess.call(['mklink', path, target], shell=True)
+        else:
+            os.symlink(target, path)
+
+    def _unlink(self, rel_path, is_dir):
+        path = self._path(rel_path)
+        if os.name == 'nt' and is_dir:
+            os.rmdir(path)
+        else:
+            os.unlink(path)
+
+    def _run(self, ops):
+        """Run (action, rel_path, args) operations in order
+
+        Returns the (action, rel_path) pairs that succeeded and the
+        (rel_path, error) pairs of the ones that failed.
+        """
+        done = []
+        errors = []
+        for action, rel_path, args in ops:
+            try:
+                action(rel_path, *args)
+            except OSError as e:
+                errors.append((rel_path, e))
+                continue
+            done.append((action, rel_path))
+        return done, errors
+
+    def _map(self, executor, groups):
+        done = []
+        errors = []
+        for result in executor.map(self._run, groups):
+            done += result[0]
+            errors += result[1]
+        return done, errors
+
+    def _rmdir(self, rel_path):
+        os.rmdir(self._path(rel_path))
+
+    def _mkdir(self, rel_path):
+        os.mkdir(self._path(rel_path))
+
+    def _remove(self, rel_path):
+        self._unlink(rel_path, os.name == 'nt'
+                     and os.path.isdir(self._path(rel_path)))
+
+    def _retarget(self, rel_path, target, is_dir):
+        self._unlink(rel_path, is_dir)
+        self._symlink(rel_path, target, is_dir)
+
+    def apply(self, plan, max_workers=1):
+        """Make the planned changes using up to max_workers threads
+
+        Directories are created level by level, parents first. The link
+        changes are then grouped by directory: each group runs in order
+        in one thread, and the groups run concurrently.
+
+        Returns the relative paths of the links created (or retargeted)
+        and removed, the (path, error) pairs of the failed changes and
+        the number of changes of each kind ('mkdir', 'rmdir', 'link',
+        'retarget', 'remove') that succeeded.
+        """
+        created = []
+        removed = []
+        errors = []
+        done = []
+        levels = collections.OrderedDict()
+        for rel_path in plan.mkdirs:
+            levels.setdefault(rel_path.count(os.sep), []).append(
+                [(self._mkdir, rel_path, ())])
+        by_dir = collections.OrderedDict()
+        ops = ([(self._remove, p, ()) for p in plan.removals]
+               + [(self._rmdir, p, ()) for p in plan.rmdirs]
+               + [(self._retarget, p, (t, d)) for p, t, d in plan.retargets]
+               + [(self._symlink, p, (t, d)) for p, t, d in plan.links])
+        for op in ops:
+            by_dir.setdefault(os.path.dirname(op[1]), []).append(op)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for groups in levels.values():
+                level_done, level_errors = self._map(executor, groups)
+                done += level_done
+                errors += level_errors
+            failed = set(p for p, e in errors)
+            # Skip links in the directories that couldn't be created
+            groups = [[op for op in dir_ops
+                       if os.path.dirname(op[1]) not in failed]
+                      for dir_ops in by_dir.values()]
+            link_done, link_errors = self._map(executor, groups)
+        done += link_done
+        errors += link_errors
+
+        names = {self._mkdir: 'mkdir', self._rmdir: 'rmdir',
+                 self._symlink: 'link', self._retarget: 'retarget',
+                 self._remove: 'remove'}
+        counts = dict((name, 0) for name in names.values())
+        for action, rel_path in done:
+            counts[names[action]] += 1
+            if action == self._remove:
+                removed.append(rel_path)
+            elif action not in (self._mkdir, self._rmdir):
+                created.append(rel_path)
+        return created, removed, errors, counts
@@ -1,118 +1,179 @@
 # -*- coding: utf-8 -*-
 import json
-import shelve
-import time
-try:
-    from cPickle import UnpicklingError
-except ImportError:
-    from pickle import UnpicklingError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import requests
+from cache import DAY, Cache
+from httpclient import HostClient
 
 
 class TMDb(object):
     api_key = None
     cache_file = None
-    request_count = 0
-
-    def __init__(self, api_key, cache_file=None):
+    # Counts the cache hits and misses, if set
+    metrics = None
+    # Only use cached responses
+    offline = False
+    base_url = 'https://api.themoviedb.org/3'
+    # Seconds to keep each kind of response
+    cache_ttl = {
+        'details': DAY,
+        'external_ids': 30 * DAY,
+    }
+    # TMDb allows around 50 requests per second per IP
+    rate_limit = 40
+    max_workers = 8
+    # Cache writes are batched while fetching details concurrently
+    batch_size = 50
+
+    def __init__(self, api_key, cache_file=None, rate_limit=None,
+                 max_workers=None, cache_ttl=None, base_url=None,
+                 http=None):
         self.api_key = api_key
+        if base_url:
+            self.base_url = base_url.rstrip('/')
         if cache_file:
             self.cache_file = cache_file
         else:
-            self.cache_file = 'tmdb_details.shelve'
+            self.cache_file = 'tmdb_cache.sqlite'
+        if rate_limit:
+            self.rate_limit = rate_limit
+        if max_workers:
+            self.max_workers = max_workers
+        self.cache_ttl = dict(self.cache_ttl, **(cache_ttl or {}))
+        self.cache = Cache(self.cache_file, ttls=self.cache_ttl)
+        # Can be shared with other clients of the API
+        self.http = http or HostClient('TMDb', rate=self.rate_limit,
+                                       max_concurrent=self.max_workers)
+
+    def _request(self, url, params):
+        """GET from the TMDb API, see httpclient.HostClient"""
+        return self.http.get(url, params=params)
+
+    def _count_lookups(self, hits, misses):
+        if self.metrics is not None:
+            self.metrics.add_many([
+                ('cache_lookups', hits, {'service': 'tmdb', 'result': 'hit'}),
+                ('cache_lookups', misses,
+                 {'service': 'tmdb', 'result': 'miss'}),
+            ])
 
     def get_imdb_id(self, tmdb_id, library_type='movie'):
         if library_type not in ('movie', 'tv'):
             raise Exception("Library type should be 'movie' or 'tv'")
 
-        # Use cache
-        cache = shelve.open(self.cache_file)
-        if str(tmdb_id) in cache:
-            try:
-                cache_item = cache[str(tmdb_id)]
-            except (EOFError, UnpicklingError):
-                # Cache file error, clear
-                cache.close()
-                cache = shelve.open(self.cache_file, 'n')
-            else:
-                if (cache_item['cached'] + 3600 * 24) > int(time.time()):
-                    cache.close()
-                    return cache_item.get('imdb_id')
+        if library_type == 'movie':
+            # Movie details include the IMDb ID
+            details = self.get_details(tmdb_id, library_type)
+            return details.get('imdb_id') if details else None
 
-        # Wait 10 seconds for the TMDb rate limit
-        if self.request_count >= 40:
-            print(u"Waiting 10 seconds for the TMDb rate limit...")
-            time.sleep(10)
-            self.request_count = 0
+        # Use cache
+        cache_item = self.cache.get(library_type, tmdb_id, 'external_ids')
+        self._count_lookups(1 if cache_item else 0, 0 if cache_item else 1)
+        if cache_item:
+            return cache_item.get('imdb_id')
+        if self.offline:
+            return None
 
         params = {
             'api_key': self.api_key,
         }
 
-        if library_type == 'movie':
-            url = "https://api.themoviedb.org/3/movie/{tmdb_id}".format(
-                tmdb_id=tmdb_id)
-        else:
-            url = ("https://api.themoviedb.org/3/tv/{tmdb_id}/external_ids"
-                   .format(tmdb_id=tmdb_id))
-        r = requests.get(url, params=params)
-
-        self.request_count += 1
+        url = "{base_url}/tv/{tmdb_id}/external_ids".format(
+            base_url=self.base_url, tmdb_id=tmdb_id)
+        r = self._request(url, params)
 
         if r.status_code == 200:
             item = json.loads(r.text)
-            item['cached'] = int(time.time())
-            cache[str(tmdb_id)] = item
-            cache.close()
+            self.cache.put(library_type, tmdb_id, 'external_ids', item)
             return item.get('imdb_id')
         else:
             return None
 
-    def get_details(self, tmdb_id, library_type='movie'):
-        if library_type not in ('movie', 'tv'):
-            raise Exception("Library type should be 'movie' or 'tv'")
-
-        # Use cache
-        cache = shelve.open(self.cache_file)
-        if str(tmdb_id) in cache:
-            try:
-                cache_item = cache[str(tmdb_id)]
-            except (EOFError, UnpicklingError):
-                # Cache file error, clear
-                cache.close()
-                cache = shelve.open(self.cache_file, 'n')
-            else:
-                if (cache_item['cached'] + 3600 * 24) > int(time.time()):
-                    cache.close()
-                    return cache_item
-
-        # Wait 10 seconds for the TMDb rate limit
-        if self.request_count >= 40:
-            print(u"Waiting 10 seconds for the TMDb rate limit...")
-            time.sleep(10)
-            self.request_count = 0
-
+    def _fetch_details(self, tmdb_id, library_type):
+        if self.offline:
+            return None
         params = {
             'api_key': self.api_key,
         }
 
         if library_type == 'movie':
             params['append_to_response'] = 'release_dates'
-            url = "https://api.themoviedb.org/3/movie/{tmdb_id}".format(
-                    tmdb_id=tmdb_id)
+            url = "{base_url}/movie/{tmdb_id}".format(
+                    base_url=self.base_url, tmdb_id=tmdb_id)
         else:
-            url = "https://api.themoviedb.org/3/tv/{tmdb_id}".format(
-                    tmdb_id=tmdb_id)
-        r = requests.get(url, params=params)
-
-        self.request_count += 1
+            url = "{base_url}/tv/{tmdb_id}".format(
+                    base_url=self.base_url, tmdb_id=tmdb_id)
+        r = self._request(url, params)
 
         if r.status_code == 200:
-            item = json.loads(r.text)
-            item['cached'] = int(time.time())
-            cache[str(tmdb_id)] = item
-            cache.close()
-            return item
+            return json.loads(r.text)
         else:
             return None
+
+    def get_details(self, tmdb_id, library_type='movie', cached_only=False):
+        """Return the details of an item, or None
+
+        With cached_only, nothing is fetched and misses aren't counted;
+        they are expected to be looked up again.
+        """
+        if library_type not in ('movie', 'tv'):
+            raise Exception("Library type should be 'movie' or 'tv'")
+
+        # Use cache
+        cache_item = self.cache.get(library_type, tmdb_id, 'details')
+        self._count_lookups(1 if cache_item else 0,
+                            0 if cache_item or cached_only else 1)
+        if cache_item or cached_only:
+            return cache_item
+
+        item = self._fetch_details(tmdb_id, library_type)
+        if item:
+            self.cache.put(library_type, tmdb_id, 'details', item)
+        return item
+
+    def iter_details(self, tmdb_ids, library_type='movie'):
+        """Fetch details for many items concurrently
+
+        Yields (tmdb_id, details) pairs, cached ones first and the rest in
+        the order they complete. Details that couldn't be fetched are None.
+        """
+        if library_type not in ('movie', 'tv'):
+            raise Exception("Library type should be 'movie' or 'tv'")
+
+        tmdb_ids = set(tmdb_ids)
+        cached = self.cache.get_many(
+            (library_type, tmdb_id, 'details') for tmdb_id in tmdb_ids)
+        self._count_lookups(len(cached), len(tmdb_ids) - len(cached))
+        missing = []
+        for tmdb_id in tmdb_ids:
+            key = (library_type, str(tmdb_id), 'details')
+            if key in cached:
+                yield tmdb_id, cached[key]
+            else:
+                missing.append(tmdb_id)
+
+        batch = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = dict(
+                (executor.submit(self._fetch_details, tmdb_id, library_type),
+                 tmdb_id)
+                for tmdb_id in missing)
+            try:
+                for future in as_completed(futures):
+                    tmdb_id = futures[future]
+                    try:
+                        item = future.result()
+                    except Exception as e:
+                        # Only this item goes without details
+                        print(u"Unable to get the TMDb details of "
+                              u"{tmdb_id}: {e}".format(tmdb_id=tmdb_id, e=e))
+                        item = None
+                    if item:
+                        batch.append(
+                            ((library_type, tmdb_id, 'details'), item))
+                        if len(batch) >= self.batch_size:
+                            self.cache.put_many(batch)
+                            batch = []
+                    yield tmdb_id, item
+            finally:
+                self.cache.put_many(batch)
@@ -1,22 +1,49 @@
 # -*- coding: utf-8 -*-
 import datetime
 import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
-import requests
 import trakt
 
+from cache import DAY, Cache
+from httpclient import HostClient
+from mediaitem import ItemCollection, MediaItem
 from utils import add_years
 
+
 class Trakt(object):
+    # Fed with the ids of every list item, if set
+    crosswalk = None
+    # Lists fetched at the same time
+    max_workers = 6
+    # Trakt allows 1000 GET requests per 5 minutes
+    rate_limit = 1000
+    rate_period = 300
+    # Items per request when paging through lists with a limit
+    page_size = 100
+    # Seconds to keep list pages (and their ETags) for revalidation, and
+    # the state of the last run of each recipe
+    cache_ttl = {
+        'page': 7 * DAY,
+        'state': DAY,
+    }
+
     def __init__(self, username, client_id='', client_secret='',
-                 oauth_token='', oauth=False):
+                 oauth_token='', oauth=False, cache_file=None,
+                 offline=False, http=None):
         self.username = username
         self.client_id = client_id
         self.client_secret = client_secret
         self.oauth_token = oauth_token
         self.oauth = oauth
+        # Only read lists from the cache
+        self.offline = offline
         store = False
-        if oauth:
+        if offline:
+            # Nothing to authenticate, the lists come from the cache
+            pass
+        elif oauth:
             if not self.oauth_token:
                 self.oauth_token = trakt.core.oauth_auth(
                     username, client_id=client_id, client_secret=client_secret,
@@ -29,13 +56,22 @@ class Trakt(object):
                                 client_secret=client_secret)
         self.trakt = trakt
         self.trakt_core = trakt.core.Core()
+        # Keep-alive connections shared by all requests (requests asks
+        # for gzip by default), and with other clients of the API
+        self.http = http or HostClient(
+            'Trakt', rate=self.rate_limit, period=self.rate_period,
+            max_concurrent=self.max_workers)
+        self.cache = None
+        if cache_file:
+            self.cache = Cache(cache_file, ttls=self.cache_ttl)
 
-    def _handle_request(self, method, url, data=None):
+    def _request(self, method, url, data=None, extra_headers=None):
         """Stolen from trakt.core to support optional OAUTH operations
         :todo: Fix trakt
         """
         headers = {'Content-Type': 'application/json',
                    'trakt-api-version': '2'}
+        headers.update(extra_headers or {})
         # self.logger.debug('%s: %s', method, url)
         headers['trakt-api-key'] = self.client_id
         if self.oauth:
@@ -43,37 +79,148 @@ class Trakt(object):
         # self.logger.debug('headers: %s', str(headers))
         # self.logger.debug('method, url :: %s, %s', method, url)
         if method == 'get':  # GETs need to pass data as params, not body
-            response = requests.request(method, url, params=data,
-                                        headers=headers)
+            response = self.http.request(method, url, params=data,
+                                         headers=headers)
         else:
-            response = requests.request(method, url, data=json.dumps(data),
-                                        headers=headers)
+            response = self.http.request(method, url,
+                                         data=json.dumps(data),
+                                         headers=headers)
         # self.logger.debug('RESPONSE [%s] (%s): %s',
         #     method, url, str(response))
         if response.status_code in self.trakt_core.error_map:
             raise self.trakt_core.error_map[response.status_code]()
-        elif response.status_code == 204:  # HTTP no content
+        return response
+
+    def _handle_request(self, method, url, data=None):
+        response = self._request(method, url, data=data)
+        if response.status_code == 204:  # HTTP no content
             return None
         json_data = json.loads(response.content.decode('UTF-8', 'ignore'))
         return json_data
 
-    def add_movies(self, url, movie_list=None, movie_ids=None, max_age=0):
-        if not movie_list:
-            movie_list = []
-        if not movie_ids:
-            movie_ids = []
-        max_date = add_years(max_age * -1)
-        print(u"Retrieving the trakt list: {}".format(url))
+    def _get_page(self, url, data, status=None):
+        """Return the items and the total page count of a list page
+
+        Cached pages are revalidated with their ETag/Last-Modified.
+        status['modified'] is set when the page changed.
+        """
+        cache_key = ('list', url + '?' + urlencode(sorted(data.items())),
+                     'page')
+        cached = self.cache.get(*cache_key) if self.cache else None
+        if self.offline:
+            if not cached:
+                raise Exception(
+                    "The trakt list {url} isn't cached, run the recipe "
+                    "once first".format(url=url))
+            return cached['items'], cached['page_count']
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        response = self._request('get', url, data=data,
+                                 extra_headers=headers)
+        if response.status_code == 304 and cached:
+            return cached['items'], cached['page_count']
+        if status is not None:
+            status['modified'] = True
+        if response.status_code == 204:  # HTTP no content
+            return [], 1
+        items = json.loads(response.content.decode('UTF-8', 'ignore'))
+        page_count = int(
+            response.headers.get('X-Pagination-Page-Count') or 1)
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if self.cache and (etag or last_modified):
+            self.cache.put(*cache_key, value={
+                'etag': etag,
+                'last_modified': last_modified,
+                'items': items,
+                'page_count': page_count,
+            })
+        return items, page_count
+
+    def _list_request(self, url, max_age=0):
+        """Return the base url, params and item limit of a list
+
+        The limit of the url is taken out and requested in pages instead.
+        """
         data = {}
         if max_age != 0:
             data['extended'] = 'full'
-        movie_data = self._handle_request('get', url, data=data)
+        parts = urlsplit(url)
+        query = parse_qsl(parts.query)
+        limit = [int(v) for k, v in query if k == 'limit']
+        if not limit:
+            return url, data, None
+        data['limit'] = min(limit[0], self.page_size)
+        data['page'] = 1
+        url = urlunsplit(parts._replace(query=urlencode(
+            [(k, v) for k, v in query if k not in ('limit', 'page')])))
+        return url, data, limit[0]
+
+    def _first_page(self, url, max_age=0, status=None):
+        print(u"Retrieving the trakt list: {}".format(url))
+        url, data, limit = self._list_request(url, max_age)
+        return self._get_page(url, data, status)
+
+    def iter_list(self, url, max_age=0, first_page=None, status=None):
+        """Yield the items of a list as its pages arrive
+
+        Lists with a limit are fetched page_size items at a time,
+        following the X-Pagination headers until the limit is reached.
+        Stop iterating to skip the remaining pages.
+        """
+        if first_page is None:
+            items, page_count = self._first_page(url, max_age, status)
+        else:
+            items, page_count = first_page.result()
+        url, data, limit = self._list_request(url, max_age)
+        count = 0
+        while True:
+            for item in items:
+                if limit and count >= limit:
+                    return
+                count += 1
+                yield item
+            if not limit or count >= limit or not items \
+                    or data['page'] >= page_count:
+                return
+            data['page'] += 1
+            items, page_count = self._get_page(url, data, status)
+
+    def iter_lists(self, urls, max_age=0, status=None):
+        """Yield (url, item iterator) pairs in the order of urls
+
+        The first pages of all lists are fetched concurrently up front;
+        pending requests are cancelled when the iteration stops early.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        first_pages = [executor.submit(self._first_page, url, max_age,
+                                       status)
+                       for url in urls]
+        try:
+            for url, first_page in zip(urls, first_pages):
+                yield url, self.iter_list(url, max_age, first_page, status)
+        finally:
+            for first_page in first_pages:
+                first_page.cancel()
+            executor.shutdown(wait=False)
+
+    def add_movies(self, url, movies=None, max_age=0, movie_data=None,
+                   enough=None):
+        if movies is None:
+            movies = ItemCollection()
+        max_date = add_years(max_age * -1)
+        if movie_data is None:
+            movie_data = self.iter_list(url, max_age=max_age)
         for m in movie_data:
             if 'movie' not in m:
                 m['movie'] = m
-            # Skip already added movies
-            if m['movie']['ids']['imdb'] in movie_ids:
-                continue
+            if self.crosswalk is not None:
+                self.crosswalk.add('movie', m['movie']['ids'])
             if not m['movie']['year']:  # TODO: Handle this better?
                 continue
             # Skip old movies
@@ -81,61 +228,63 @@ class Trakt(object):
                     and (max_date > datetime.datetime.strptime(
                         m['movie']['released'], '%Y-%m-%d')):
                 continue
-            movie_list.append({
-                'id': m['movie']['ids']['imdb'],
-                'tmdb_id': m['movie']['ids'].get('tmdb', ''),
-                'title': m['movie']['title'],
-                'year': m['movie']['year'],
-            })
-            movie_ids.append(m['movie']['ids']['imdb'])
-            if m['movie']['ids'].get('tmdb'):
-                movie_ids.append('tmdb' + str(m['movie']['ids']['tmdb']))
+            # Skip already added movies
+            if not movies.add(MediaItem(
+                    m['movie']['ids']['imdb'],
+                    tmdb_id=m['movie']['ids'].get('tmdb', ''),
+                    title=m['movie']['title'],
+                    year=m['movie']['year'])):
+                continue
+            if enough and enough(movies):
+                break
+        if self.crosswalk is not None:
+            self.crosswalk.flush()
 
-        return (movie_list, movie_ids)
+        return movies
 
-    def add_shows(self, url, show_list=None, show_ids=None, max_age=0):
-        if not show_list:
-            show_list = []
-        if not show_ids:
-            show_ids = []
+    def add_shows(self, url, shows=None, max_age=0, show_data=None,
+                  enough=None):
+        if shows is None:
+            shows = ItemCollection()
         curyear = datetime.datetime.now().year
-        print(u"Retrieving the trakt list: {}".format(url))
-        data = {}
-        if max_age != 0:
-            data['extended'] = 'full'
-        show_data = self._handle_request('get', url, data=data)
+        if show_data is None:
+            show_data = self.iter_list(url, max_age=max_age)
         for m in show_data:
             if 'show' not in m:
                 m['show'] = m
-            # Skip already added shows
-            if m['show']['ids']['imdb'] in show_ids:
-                continue
+            if self.crosswalk is not None:
+                self.crosswalk.add('tv', m['show']['ids'])
             if not m['show']['year']:
                 continue
             # Skip old shows
             if max_age != 0 \
                     and (curyear - (max_age - 1)) > int(m['show']['year']):
                 continue
-            show_list.append({
-                'id': m['show']['ids']['imdb'],
-                'tmdb_id': m['show']['ids'].get('tmdb', ''),
-                'tvdb_id': m['show']['ids'].get('tvdb', ''),
-                'title': m['show']['title'],
-                'year': m['show']['year'],
-            })
-            show_ids.append(m['show']['ids']['imdb'])
-            if m['show']['ids'].get('tmdb'):
-                show_ids.append('tmdb' + str(m['show']['ids']['tmdb']))
-            if m['show']['ids'].get('tvdb'):
-                show_ids.append('tvdb' + str(m['show']['ids']['tvdb']))
+            # Skip already added shows
+            if not shows.add(MediaItem(
+                    m['show']['ids']['imdb'],
+                    tmdb_id=m['show']['ids'].get('tmdb', ''),
+                    tvdb_id=m['show']['ids'].get('tvdb', ''),
+                    title=m['show']['title'],
+                    year=m['show']['year'])):
+                continue
+            if enough and enough(shows):
+                break
+        if self.crosswalk is not None:
+            self.crosswalk.flush()
 
-        return (show_list, show_ids)
+        return shows
 
-    def add_items(self, item_type, url, item_list=None, item_ids=None,
-                  max_age=0):
+    def add_items(self, item_type, url, items=None, max_age=0, data=None,
+                  enough=None):
+        """Add the items of a list not seen before to an ItemCollection
+
+        `enough` is called with the collection after every added item;
+        returning True stops reading the list.
+        """
         if item_type == 'movie':
-            return self.add_movies(url, movie_list=item_list,
-                                   movie_ids=item_ids, max_age=max_age)
+            return self.add_movies(url, movies=items, max_age=max_age,
+                                   movie_data=data, enough=enough)
         elif item_type == 'tv':
-            return self.add_shows(url, show_list=item_list,
-                                  show_ids=item_ids, max_age=max_age)
+            return self.add_shows(url, shows=items, max_age=max_age,
+                                  show_data=data, enough=enough)
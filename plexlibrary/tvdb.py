@@ -1,45 +1,165 @@
 # -*- coding: utf-8 -*-
-import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import DAY, Cache
+from httpclient import HostClient
 
 
 class TheTVDB(object):
     token = None
+    cache_file = None
+    # Only use cached responses
+    offline = False
+    base_url = 'https://api.thetvdb.com'
+    # Seconds to keep each kind of response. Tokens are valid for 24 hours
+    # and get refreshed once they're older than token_refresh.
+    cache_ttl = {
+        'series': 30 * DAY,
+        'token': DAY,
+    }
+    token_refresh = 20 * 3600
+    rate_limit = 20
+    max_workers = 8
 
-    def __init__(self, username, api_key, user_key):
+    def __init__(self, username, api_key, user_key, cache_file=None,
+                 rate_limit=None, max_workers=None, cache_ttl=None,
+                 base_url=None, http=None):
         self.username = username
         self.api_key = api_key
         self.user_key = user_key
+        if base_url:
+            self.base_url = base_url.rstrip('/')
+        if cache_file:
+            self.cache_file = cache_file
+        else:
+            self.cache_file = 'tvdb_cache.sqlite'
+        if rate_limit:
+            self.rate_limit = rate_limit
+        if max_workers:
+            self.max_workers = max_workers
+        self.cache_ttl = dict(self.cache_ttl, **(cache_ttl or {}))
+        self.cache = Cache(self.cache_file, ttls=self.cache_ttl)
+        # Can be shared with other clients of the API
+        self.http = http or HostClient('TheTVDB', rate=self.rate_limit,
+                                       max_concurrent=self.max_workers)
+        self._token_lock = threading.Lock()
+        self._token_issued = 0
 
-    def get_imdb_id(self, tvdb_id):
-        # TODO Cache
-        if not self.token:
-            self._refresh_token()
+    def _get_token(self, rejected=None):
+        """Return a valid token, from the cache if possible
 
-        url = "https://api.thetvdb.com/series/{tvdb_id}".format(
-            tvdb_id=tvdb_id)
-        headers = {
-            'Authorization': 'Bearer {token}'.format(token=self.token)
-        }
-        r = requests.get(url, headers=headers)
+        Tokens close to expiring are refreshed, and expired ones (or the
+        rejected one) are replaced by logging in again.
+        """
+        with self._token_lock:
+            renew = rejected is not None and rejected == self.token
+            if not self.token:
+                cached = self.cache.get('token', self.username, 'token')
+                if cached:
+                    self.token = cached['token']
+                    self._token_issued = cached['issued']
+            age = time.time() - self._token_issued
+            if renew or not self.token or age >= self.cache_ttl['token']:
+                self._login()
+            elif age >= self.token_refresh:
+                self._refresh_token()
+            return self.token
 
-        if r.status_code == 200:
-            tv_show = r.json()
-            return tv_show['data']['imdbId']
-        else:
-            return None
+    def _save_token(self, token):
+        self.token = token
+        self._token_issued = int(time.time())
+        self.cache.put('token', self.username, 'token', {
+            'token': token,
+            'issued': self._token_issued,
+        })
 
-    def _refresh_token(self):
+    def _login(self):
         data = {
             'apikey': self.api_key,
             'userkey': self.user_key,
             'username': self.username,
         }
 
-        url = "https://api.thetvdb.com/login"
-        r = requests.post(url, json=data)
+        url = "{base_url}/login".format(base_url=self.base_url)
+        r = self.http.post(url, json=data)
 
         if r.status_code == 200:
             result = r.json()
-            self.token = result['token']
+            self._save_token(result['token'])
         else:
+            self.token = None
+            raise Exception("Unable to log in to TheTVDB: {status}".format(
+                status=r.status_code))
+
+    def _refresh_token(self):
+        url = "{base_url}/refresh_token".format(base_url=self.base_url)
+        headers = {
+            'Authorization': 'Bearer {token}'.format(token=self.token)
+        }
+        r = self.http.get(url, headers=headers)
+
+        if r.status_code == 200:
+            self._save_token(r.json()['token'])
+        else:
+            self._login()
+
+    def _headers(self, token):
+        return {'Authorization': 'Bearer {token}'.format(token=token)}
+
+    def _request(self, url):
+        """GET from TheTVDB API, see httpclient.HostClient
+
+        A rejected token is replaced once.
+        """
+        token = self._get_token()
+        r = self.http.get(url, headers=self._headers(token))
+        if r.status_code == 401:
+            token = self._get_token(rejected=token)
+            r = self.http.get(url, headers=self._headers(token))
+        return r
+
+    def _fetch_imdb_id(self, tvdb_id):
+        if self.offline:
+            return None
+        url = "{base_url}/series/{tvdb_id}".format(
+            base_url=self.base_url, tvdb_id=tvdb_id)
+        r = self._request(url)
+
+        if r.status_code == 200:
+            tv_show = r.json()
+            imdb_id = tv_show['data']['imdbId'] or None
+        elif r.status_code == 404:
+            imdb_id = None
+        else:
+            # Don't cache errors
             return None
+        self.cache.put('tv', tvdb_id, 'series', {'imdbId': imdb_id})
+        return imdb_id
+
+    def get_imdb_id(self, tvdb_id):
+        return self.get_imdb_ids([tvdb_id]).get(tvdb_id)
+
+    def get_imdb_ids(self, tvdb_ids):
+        """Return {tvdb_id: imdb_id} for many shows
+
+        Shows that aren't cached are looked up concurrently.
+        """
+        tvdb_ids = set(tvdb_ids)
+        cached = self.cache.get_many(
+            ('tv', tvdb_id, 'series') for tvdb_id in tvdb_ids)
+        res = {}
+        missing = []
+        for tvdb_id in tvdb_ids:
+            key = ('tv', str(tvdb_id), 'series')
+            if key in cached:
+                res[tvdb_id] = cached[key]['imdbId']
+            else:
+                missing.append(tvdb_id)
+
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                res.update(zip(missing,
+                               executor.map(self._fetch_imdb_id, missing)))
+        return res
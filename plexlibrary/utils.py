@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import os
+import tempfile
 from datetime import datetime
 
 import yaml
@@ -52,3 +54,23 @@ def add_years(years, from_date=None):
         # Must be 2/29!
         return from_date.replace(month=2, day=28,
                                  year=from_date.year + years)
+
+
+def write_atomic(path, text):
+    """Replace the file at path with text, never leaving half of it
+
+    The text is written to a temporary file next to it first, which is
+    removed again if that fails.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""weighting
+
+Columnar scoring engine for weighted sorting
+"""
+
+import random
+from array import array
+
+
+def age_limits(library_type, max_age):
+    """Return the ages (days) that get a full and a zero age weight"""
+    if library_type == 'movie':
+        # Everything younger than 180 days will get 1
+        return 180, float(max_age or 0) / 4.0 * 365.25 or 360
+    return 14, float(max_age or 0) / 4.0 * 365.25 or 180
+
+
+def vote_weights(votes, eligible):
+    """Rank each eligible vote among all eligible votes, from 0 to 1
+
+    Items with too few votes get a below average weight of 0.25.
+    """
+    ranked = sorted(v for v, e in zip(votes, eligible) if e)
+    total = float(len(ranked))
+    # 1-based position of the first occurrence of each vote
+    positions = dict((v, i) for i, v in reversed(list(enumerate(ranked, 1))))
+    return array('d', [positions[v] / total if e else 0.25
+                       for v, e in zip(votes, eligible)])
+
+
+def age_weights(ages, min_days, max_days):
+    return array('d', [1 if d <= min_days else
+                       0 if d >= max_days else
+                       1 - (d - min_days) / (max_days - min_days)
+                       for d in ages])
+
+
+def genre_factors(genres, genre_bias):
+    """Return the genre bias multipliers that apply to each item
+
+    Items with the same genres share the same (cached) list.
+    """
+    bias = [(genre.lower(), value) for genre, value in genre_bias.items()]
+    by_genres = {}
+    factors = []
+    for item_genres in genres:
+        key = tuple(item_genres)
+        if key not in by_genres:
+            item_genres = set(item_genres)
+            by_genres[key] = [v for g, v in bias if g in item_genres]
+        factors.append(by_genres[key])
+    return factors
+
+
+def score(item_list, weights, library_type, max_age, rng=random):
+    """Compute the weights of every item in one pass per column
+
+    Sets index_weight, vote_weight, age_weight, random_weight and weight
+    on the MediaItems. Items without TMDb details only get their (unscaled)
+    index weight.
+    """
+    total_items = len(item_list)
+    has_details = [bool(m.tmdb_popularity) for m in item_list]
+    votes = [m.tmdb_vote for m in item_list]
+    ages = [float(m.age) for m in item_list]
+    # Every item with TMDb details counts towards the vote ranking
+    eligible = [m.tmdb_vote is not None and (library_type == 'tv'
+                                             or m.tmdb_vote_count > 150
+                                             or m.age > 50)
+                for m in item_list]
+
+    # Distribute all weights evenly from 0 to 1 (times global factor)
+    # More weight means it'll go higher in the final list
+    index = array('d', [float(total_items - i) / float(total_items)
+                        for i in range(total_items)])
+    vote = vote_weights(votes, eligible)
+    age = age_weights(ages, *age_limits(library_type, max_age))
+    if weights.get('random'):
+        rnd = array('d', [rng.random() * weights['random'] if h else 0.0
+                          for h in has_details])
+    else:
+        rnd = array('d', [0.0]) * total_items
+    factors = genre_factors([m.genres for m in item_list],
+                            weights.get('genre_bias') or {})
+
+    for i, m in enumerate(item_list):
+        m.index_weight = index[i] * weights['index']
+        if not has_details[i]:
+            m.vote_weight = 0.0
+            m.age_weight = 0.0
+            m.weight = index[i]
+            continue
+        m.vote_weight = vote[i] * weights['vote']
+        m.age_weight = age[i] * weights['age']
+        m.random_weight = rnd[i]
+        weight = (m.index_weight + m.vote_weight
+                  + m.age_weight + m.random_weight)
+        for value in factors[i]:
+            weight *= value
+        m.weight = weight
+
+    return item_list